@@ -14,22 +14,92 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import wx
-import wx.lib.wxcairo
+# the window needs wxPython, the command line renders without it.
+# Without wx the window classes get plain bases and are never used
+try:
+	import wx
+	import wx.lib.wxcairo
+	WindowBase, DialogBase, FrameBase = wx.Window, wx.Dialog, wx.Frame
+except ImportError:
+	wx = None
+	WindowBase = DialogBase = FrameBase = object
 import cairo
 
 import os.path
+import sys
+import json
+import argparse
+import multiprocessing
+import Queue
+import io
+import tempfile
+import struct
 
 # to load images:
-#from PIL import Image
+try:
+	from PIL import Image, JpegImagePlugin		# only needed to render non png images without wx
+except ImportError:
+	Image = None
+	JpegImagePlugin = None
 #import PIL.ImageOps 
-#import numpy
+import numpy
 
 import math
+import collections
+import time
+import csv
+import itertools
+import threading
+import hashlib
 
 
 USE_BUFFERED_DC = True
 
+# large images are painted in tiles, only the visible ones are drawn
+TILE_SIZE 		= 256 	# px
+TILE_CACHE_MB 	= 256 	# memory budget of the tile cache
+
+# mouse motion and wheel events are redrawn at most this often
+REDRAW_FPS 		= 60
+
+# distance in pixels from a line that still counts as a hit
+HIT_TOLERANCE 	= 3
+
+# a spec of a batch that has no result after this many seconds failed,
+# its worker may have died (a killed process never reports back)
+RENDER_TIMEOUT 	= 1800
+
+# resolution of png exports, one unit on the canvas is 1/96 inch
+EXPORT_DPI 		= 300
+PNG_MAX_SIZE 	= 32767 	# px, the largest image surface of cairo
+
+# how the image is stored in svg exports: png, jpeg, downsample or link
+SVG_IMAGE 		= {"codec": "png", "quality": 90, "downsample": 2}
+
+# projects are saved next to the image, changes are appended to the file
+# and it is rewritten as a whole after this many changes
+PROJECT_EXTENSION 		= ".gelproj"
+PROJECT_COMPACT_RECORDS = 100
+AUTOSAVE_SECONDS 		= 5
+
+# undo steps that are kept, older ones are dropped
+HISTORY_LIMIT = 500
+
+# longest side of the preview that is shown while a large image is read
+PREVIEW_SIZE = 1024
+
+# some ladders, feel free to add some
+LADDERS = {	"Eurogentec smartLadder":[10000,8000,6000,5000,4000,3000,2500,2000,1500,1000,800,600],
+			"NEB 1 kb DNA Ladder":[10000,8000,6000,5000,4000,3000,2000,1500,1000,500],
+			"NEB Low Molecular Weight DNA Ladder":[766,500,350,300,250,200,150,100,75,50,25],
+			"Thermo Scientific GeneRuler DNA Ladder Mix": [10000,8000,6000,5000,4000,3500,3000,2500,2000,1500,1200,1000,900,800,700,600,500,400,300,200,100],
+			"Thermo Scientific GeneRuler 100 bp DNA Ladder ": [1000,900,800,700,600,500,400,300,200,100],
+			"Invitrogen 1 Kb Plus DNA Ladder": [12000,5000,2000,1650,1000,850,650,500,400,300,200,100],
+			"NEB Purple 2-Log DNA Ladder": [10000,8000,6000,5000,4000,3000,2000,1500,1200,1000,900,800,700,600,500,400,300,200,100],
+			"Ultra Low Range DNA-Leiter II (peqlab)":[700,500,400,300,200,150,100,75,50,25]}
+
+UNITS = ["bp","kbp","Da","kDa","u","ku"]
+
 labelList = {
 				"abc": ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'w', 'x', 'y', 'z'],
 				"ABC": ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S', 'T', 'U', 'V', 'W', 'X', 'Y', 'Z']
@@ -37,7 +107,7 @@ labelList = {
 			}
 
 
-class BufferedWindow(wx.Window):
+class BufferedWindow(WindowBase):
 
     """
 
@@ -71,7 +141,7 @@ class BufferedWindow(wx.Window):
         self.paint_count = 0
 
 
-    def Draw(self, dc):
+    def Draw(self, dc, clip=False):
         ## just here as a place holder.
         ## This method should be over-ridden when subclassed
         pass
@@ -96,13 +166,15 @@ class BufferedWindow(wx.Window):
         self._Buffer = wx.EmptyBitmap(*Size)
         self.UpdateDrawing()
 
-    def SaveToFile(self, FileName, FileType=wx.BITMAP_TYPE_PNG):
+    def SaveToFile(self, FileName, FileType=None):
         ## This will save the contents of the buffer
         ## to the specified file. See the wxWindows docs for 
         ## wx.Bitmap::SaveFile for the details
+        if FileType is None:
+            FileType = wx.BITMAP_TYPE_PNG
         self._Buffer.SaveFile(FileName, FileType)
 
-    def UpdateDrawing(self):
+    def UpdateDrawing(self, rects=False):
         """
         This would get called if the drawing needed to change, for whatever reason.
 
@@ -111,21 +183,2507 @@ class BufferedWindow(wx.Window):
         be updated.
 
         This code re-draws the buffer, then calls Update, which forces a paint event.
+
+        If a list of damaged rectangles (x, y, width, height) is given, only
+        these are drawn again and refreshed on screen.
         """
         dc = self.dc#wx.MemoryDC()
         dc.SelectObject(self._Buffer)
-        self.Draw(dc)
+        if rects:
+            self.Draw(dc, clip=rects)
+        else:
+            self.Draw(dc)
         del dc # need to get rid of the MemoryDC before Update() is called.
-        self.Refresh()
+        if rects:
+            for x, y, width, height in rects:
+                self.RefreshRect(wx.Rect(x, y, width, height), False)
+        else:
+            self.Refresh()
         self.Update()
 
-    def ExportSVG(self, context):
-        dc = wx.MemoryDC()
-        dc.SelectObject(self._Buffer)
-        self.Draw(dc, True, context)
-        del dc # need to get rid of the MemoryDC before Update() is called.
-        self.Refresh()
-        self.Update()
+
+
+
+
+
+
+class PixelBuffer(object):
+	'''	The pixels of the image in one contiguous numpy array.
+		The array has the memory layout of a cairo FORMAT_RGB24 surface,
+		so the surface for the screen is made from it without a copy.
+		rgb is a (height, width, 3) view on the color channels, all
+		image operations change it in place.
+		
+		Pixels made from raw data are only made when their rows are
+		needed (showRows), the ImageCache asks for the rows it paints.
+		Everything that uses the whole image calls showAll() first.
+	'''
+	def __init__(self, width, height):
+		self.width 	= width
+		self.height = height
+		self.stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, width)
+		self.data 	= numpy.zeros((height, self.stride/4, 4), numpy.uint8)
+		self.rgb 	= rgbView(self.data, width)
+		self.surface = False
+		
+		# data of 16 bit images, at full bit depth for analysis
+		self.raw 	= False
+		self.tiff 	= False
+		self.rawShown = False
+		
+		# (lut, source) of pixels that are made on demand, in blocks of
+		# 256 rows. shownRows tells which blocks are made already
+		self.pending 	= False
+		self.shownRows 	= False
+		
+		# levels work on a fixed source, so moving a slider only makes a new lut
+		self.source 	= False
+		self.hist 		= False
+		self.lut 		= (False, False)
+	
+	@classmethod
+	def fromArray(cls, rgb):
+		''' from a (height, width, 3) or a gray (height, width) uint8 array '''
+		height, width = rgb.shape[:2]
+		pixels = cls(width, height)
+		if rgb.ndim == 2:
+			pixels.rgb[...] = rgb[..., numpy.newaxis]
+		else:
+			pixels.rgb[...] = rgb[..., :3]
+		return pixels
+	
+	@classmethod
+	def fromTiff(cls, tiff):
+		'''	keeps the memory mapped tiff data as raw, nothing is read.
+			The 8 bit version for the display is made when it is painted
+		'''
+		pixels 		= cls(tiff.width, tiff.height)
+		pixels.tiff = tiff
+		pixels.raw 	= tiff.view()
+		pixels.showRaw()
+		return pixels
+	
+	@classmethod
+	def previewTiff(cls, tiff, step):
+		''' every step-th pixel of a tiff, only these rows are read '''
+		raw 		= tiff.sample(step)
+		pixels 		= cls(raw.shape[1], raw.shape[0])
+		pixels.raw 	= raw
+		lut 		= pixels.rawLut()
+		if tiff.photometric == 0:
+			lut = lut[::-1].copy() 		# white is zero
+		pixels.showRaw(lut)
+		return pixels
+	
+	@classmethod
+	def fromWxImage(cls, image):
+		data = numpy.frombuffer(image.GetDataBuffer(), numpy.uint8)
+		return cls.fromArray(data.reshape(image.GetHeight(), image.GetWidth(), 3))
+	
+	@classmethod
+	def fromSurface(cls, surface):
+		surface.flush()
+		data = numpy.frombuffer(surface.get_data(), numpy.uint8)
+		data = data.reshape(surface.get_height(), surface.get_stride()/4, 4)
+		return cls.fromArray(rgbView(data, surface.get_width()))
+	
+	def getSurface(self):
+		if self.surface is False:
+			self.surface = cairo.ImageSurface.create_for_data(self.data, cairo.FORMAT_RGB24,
+										self.width, self.height, self.stride)
+		return self.surface
+	
+	def readRaw(self, x=0, y=0, width=False, height=False):
+		''' raw data of a region, only this part is read from the file '''
+		if self.tiff is not False:
+			return self.tiff.read(x, y, width, height)
+		if width is False:
+			width = self.width - x
+		if height is False:
+			height = self.height - y
+		return self.raw[y:y+height, x:x+width]
+	
+	def rawLut(self, black=False, white=False):
+		'''	lookup table from raw values to 8 bit, linear from black to white.
+			16 bit scanners rarely use the full range, the white point is the
+			brightest of every n-th pixel, the same as for the preview
+		'''
+		if black is False:
+			black = 0
+		if white is False and self.raw.dtype.itemsize == 1:
+			white = 255
+		elif white is False:
+			step 	= max(1, int(math.ceil(max(self.width, self.height) / float(PREVIEW_SIZE))))
+			white 	= max(1, int(self.raw[::step, ::step].max()))
+		size 	= 2 ** (8 * self.raw.dtype.itemsize)
+		lut 	= (numpy.arange(size, dtype=numpy.float32) - black) * (255.0 / max(1, white - black))
+		lut 	= numpy.clip(lut, 0, 255).round().astype(numpy.uint8)
+		if self.tiff is not False and self.tiff.photometric == 0:
+			lut = lut[::-1].copy() 		# white is zero
+		return lut
+	
+	def showRaw(self, lut=False):
+		''' shows the raw data through a lookup table '''
+		if lut is False:
+			lut = self.rawLut()
+		self.showThrough(lut, self.raw)
+		self.rawShown = True
+	
+	def showThrough(self, lut, source, progress=False):
+		'''	writes lut[source] to the pixels, in blocks of rows. The raw
+			data is only read when its rows are needed, other sources are
+			in memory anyway and are written at once.
+			progress is called with the done fraction before each block
+		'''
+		self.pending 	= (lut, source)
+		self.shownRows 	= numpy.zeros((self.height + 255) / 256, bool)
+		if source is not self.raw:
+			self.showAll(progress)
+		self.changed()
+	
+	def showRows(self, top=0, bottom=False, progress=False):
+		''' makes the missing 8 bit pixels of the rows from top to bottom '''
+		if self.pending is False:
+			return
+		if bottom is False:
+			bottom = self.height
+		lut, source = self.pending
+		first 	= max(0, top / 256)
+		last 	= min(len(self.shownRows), (bottom + 255) / 256)
+		for index in range(first, last):
+			if progress is not False:
+				progress(float(index - first) / (last - first))
+			if self.shownRows[index]:
+				continue
+			y 		= index * 256
+			block 	= numpy.take(lut, source[y:y+256], mode='clip')
+			if block.shape[2] < 3:
+				block = block[..., :1] 		# gray, maybe with alpha
+			self.rgb[y:y+256] = block[..., :3]
+			self.shownRows[index] = True
+		if self.shownRows.all():
+			self.pending = False
+		self.changed()
+	
+	def showAll(self, progress=False):
+		''' makes all 8 bit pixels, before the whole image is used '''
+		self.showRows(0, self.height, progress)
+	
+	def sampled(self, x, y, width, height, step):
+		'''	a surface of every step-th pixel of a region, made from the
+			source of the pending pixels without making them
+		'''
+		lut, source = self.pending
+		region 	= source[y:y+height:step, x:x+width:step]
+		pixels 	= PixelBuffer(region.shape[1], region.shape[0])
+		pixels.showThrough(lut, region)
+		return pixels.getSurface()
+	
+	def edited(self):
+		''' the pixels were changed by something else than levels '''
+		self.rawShown 	= False
+		self.source 	= False
+		self.hist 		= False
+		self.lut 		= (False, False)
+		self.changed()
+	
+	def levelSource(self):
+		'''	the data the levels are applied to: the raw data as long as
+			it is shown unchanged, otherwise a copy of the pixels
+		'''
+		if self.raw is not False and self.rawShown:
+			return self.raw
+		if self.source is False:
+			self.source = self.rgb.copy()
+		return self.source
+	
+	def maxLevel(self):
+		return 2 ** (8 * self.levelSource().dtype.itemsize) - 1
+	
+	def histogram(self):
+		''' histogram of the level source, 256 or 65536 bins, computed once '''
+		if self.hist is False:
+			source 		= self.levelSource()
+			self.hist 	= numpy.zeros(self.maxLevel() + 1, numpy.int64)
+			for y in range(0, self.height, 256):
+				self.hist += numpy.bincount(source[y:y+256].ravel(), minlength=len(self.hist))
+		return self.hist
+	
+	def autoLevels(self, clip=0.001):
+		'''	black and white point, so that a fraction of clip pixels
+			gets black and white each
+		'''
+		cumulative 	= numpy.cumsum(self.histogram())
+		total 		= cumulative[-1]
+		black 		= int(numpy.searchsorted(cumulative, total * clip))
+		white 		= int(numpy.searchsorted(cumulative, total * (1 - clip)))
+		return black, max(white, black + 1)
+	
+	def levelsLut(self, black, white, gamma=1.0):
+		''' lookup table from the level source to 8 bit, the last one is kept '''
+		key = (black, white, gamma, self.levelSource() is self.raw)
+		if self.lut[0] != key:
+			lut = (numpy.arange(self.maxLevel() + 1, dtype=numpy.float32) - black) / max(1, white - black)
+			lut = numpy.clip(lut, 0, 1) ** (1.0 / gamma) * 255
+			lut = lut.round().astype(numpy.uint8)
+			if key[3] and self.tiff is not False and self.tiff.photometric == 0:
+				lut = lut[::-1].copy() 		# white is zero
+			self.lut = (key, lut)
+		return self.lut[1]
+	
+	def levels(self, black=False, white=False, gamma=1.0):
+		'''	maps black to 0 and white to 255 with a gamma curve in between.
+			Without black and white points they are taken from the histogram.
+			The pixels are always made from the level source, so levels
+			can be changed as often as wanted without losing anything
+		'''
+		if black is False or white is False:
+			black, white = self.autoLevels()
+		self.showThrough(self.levelsLut(black, white, gamma), self.levelSource())
+		return black, white
+	
+	def rotated(self, angle):
+		'''	a new PixelBuffer of the same size with the image rotated around
+			its centre, like cairo rotates the canvas. The pixels are drawn by
+			cairo, the raw data is resampled with numpy. Corners that move out
+			are lost, the edges are extended into the new ones
+		'''
+		self.showAll()
+		pixels 	= PixelBuffer(self.width, self.height)
+		cr 		= cairo.Context(pixels.getSurface())
+		cr.translate(self.width/2.0, self.height/2.0)
+		cr.rotate(angle)
+		cr.translate(-self.width/2.0, -self.height/2.0)
+		pattern = cairo.SurfacePattern(self.getSurface())
+		pattern.set_extend(cairo.EXTEND_PAD)
+		pattern.set_filter(cairo.FILTER_BILINEAR)
+		cr.set_source(pattern)
+		cr.paint()
+		pixels.surface.flush()
+		
+		if self.raw is not False:
+			pixels.raw = rotateArray(self.readRaw(), angle)
+			pixels.rawShown = self.rawShown
+			if self.tiff is not False and self.tiff.photometric == 0:
+				pixels.tiff = self.tiff 	# keeps white is zero for the levels
+		return pixels
+	
+	def changed(self):
+		''' has to be called after the pixels were changed '''
+		if self.surface is not False:
+			self.surface.mark_dirty()
+	
+	def luminance(self):
+		''' gray values, with the same weights as wx.Image.ConvertToGreyscale '''
+		self.showAll()
+		gray = numpy.multiply(self.rgb[..., 0], 77, dtype=numpy.uint16)
+		gray += numpy.multiply(self.rgb[..., 1], 150, dtype=numpy.uint16)
+		gray += numpy.multiply(self.rgb[..., 2], 29, dtype=numpy.uint16)
+		gray += 128
+		gray >>= 8
+		return gray.astype(numpy.uint8)
+	
+	def invert(self):
+		# the padding is inverted as well, that is faster and does no harm
+		self.showAll()
+		numpy.invert(self.data, out=self.data)
+		self.edited()
+	
+	def grayscale(self):
+		self.rgb[...] = self.luminance()[..., numpy.newaxis]
+		self.edited()
+	
+	def channel(self, index):
+		''' use only one channel (0 red, 1 green, 2 blue) as gray image '''
+		self.showAll()
+		self.rgb[...] = self.rgb[..., index].copy()[..., numpy.newaxis]
+		self.edited()
+	
+	def brightnessContrast(self, brightness=0, contrast=1.0):
+		''' brightness is added (-255 to 255), contrast is a factor around the middle '''
+		lut = (numpy.arange(256) - 127.5) * contrast + 127.5 + brightness
+		self.applyLut(numpy.clip(lut, 0, 255).round().astype(numpy.uint8))
+	
+	def applyLut(self, lut):
+		''' maps every value through a lookup table of 256 entries '''
+		self.showAll()
+		numpy.take(lut, self.data, out=self.data, mode='clip')
+		self.edited()
+
+
+
+def rgbView(data, width):
+	''' red, green and blue of a (height, stride/4, 4) array in cairo RGB24 layout '''
+	if sys.byteorder == "little":
+		return data[:, :width, 2::-1]		# memory is B, G, R, unused
+	return data[:, :width, 1:]				# memory is unused, R, G, B
+
+
+
+def rotateArray(array, angle, rows=256):
+	'''	(height, width, samples) array rotated around its centre with bilinear
+		interpolation, the same direction as cairo. Done in blocks of rows
+	'''
+	height, width = array.shape[:2]
+	result 	= numpy.empty_like(array)
+	cos 	= math.cos(angle)
+	sin 	= math.sin(angle)
+	x 		= numpy.arange(width, dtype=numpy.float32) + 0.5 - width/2.0
+	for top in range(0, height, rows):
+		y = numpy.arange(top, min(top + rows, height), dtype=numpy.float32)[:, numpy.newaxis] + 0.5 - height/2.0
+		
+		# where every target pixel comes from, edges are extended
+		sourceX = numpy.clip( cos*x + sin*y + width/2.0 - 0.5, 0, width - 1)
+		sourceY = numpy.clip(-sin*x + cos*y + height/2.0 - 0.5, 0, height - 1)
+		x0 		= numpy.minimum(sourceX.astype(int), width - 2) if width > 1 else numpy.zeros(sourceX.shape, int)
+		y0 		= numpy.minimum(sourceY.astype(int), height - 2) if height > 1 else numpy.zeros(sourceY.shape, int)
+		fx 		= (sourceX - x0)[..., numpy.newaxis]
+		fy 		= (sourceY - y0)[..., numpy.newaxis]
+		x1 		= numpy.minimum(x0 + 1, width - 1)
+		y1 		= numpy.minimum(y0 + 1, height - 1)
+		
+		block 	= ((array[y0, x0] * (1 - fx) + array[y0, x1] * fx) * (1 - fy) +
+				   (array[y1, x0] * (1 - fx) + array[y1, x1] * fx) * fy)
+		result[top:top + rows] = block.round()
+	return result
+
+def estimateSkew(gray, maxAngle=math.radians(5), steps=41):
+	'''	angle that makes the lanes of a gel vertical, as rotation for cairo.
+		For every candidate angle the image is projected along that slant,
+		the sharpest projection wins. It is searched coarse, then finer
+		around the best angle. gray should be small, a few hundred pixels
+	'''
+	gray 	= numpy.asarray(gray, numpy.float64)
+	gray 	= gray - gray.mean()
+	height, width = gray.shape
+	x 		= numpy.arange(width, dtype=numpy.float64)
+	y 		= numpy.arange(height, dtype=numpy.float64) - height/2.0
+	margin 	= int(math.ceil(height * math.tan(maxAngle))) + 2
+	
+	def sharpness(angle):
+		column 	= (x[numpy.newaxis, :] - y[:, numpy.newaxis] * math.tan(angle)).round().astype(int) + margin
+		profile = numpy.bincount(column.ravel(), weights=gray.ravel(), minlength=width + 2*margin)
+		return numpy.sum(numpy.diff(profile) ** 2)
+	
+	best 	= 0.0
+	span 	= maxAngle
+	for search in range(3):
+		angles 	= numpy.linspace(best - span, best + span, steps)
+		scores 	= [sharpness(angle) for angle in angles]
+		best 	= angles[int(numpy.argmax(scores))]
+		span 	= 2 * span / (steps - 1)
+	return best
+
+
+
+# gel analysis, all on 1D profiles of the image
+
+def smoothProfile(profile, width):
+	''' moving average over width samples, same length as profile '''
+	width = max(1, int(width))
+	if width == 1:
+		return numpy.asarray(profile, numpy.float64)
+	kernel = numpy.ones(width) / width
+	padded = numpy.pad(numpy.asarray(profile, numpy.float64), (width/2, width - 1 - width/2), 'edge')
+	return numpy.convolve(padded, kernel, 'valid')
+
+def darkBands(profile):
+	'''	True if the lanes (and their bands) are darker than the gel, from
+		the column projection. The ends of the profile are gel outside of
+		the lanes, lanes can fill most of the width so the median can be
+		a lane. Only if the ends look like the median, the extremes
+		decide: narrow lanes lie further from the median than the gel
+	'''
+	profile = numpy.asarray(profile, numpy.float64)
+	median 	= numpy.median(profile)
+	spread 	= profile.max() - profile.min()
+	edge 	= max(1, min(4, len(profile) / 10))
+	border 	= numpy.median(numpy.concatenate((profile[:edge], profile[-edge:])))
+	if spread > 0 and abs(border - median) > 0.1 * spread:
+		return border > median
+	return median - profile.min() > profile.max() - median
+
+def profileSignal(profile, dark=True):
+	'''	profile with the bands as positive values on a background of 0.
+		Lanes can fill most of the gel, so the background is taken from
+		the brightest (or darkest) tenth of the profile
+	'''
+	profile = numpy.asarray(profile, numpy.float64)
+	if dark:
+		return numpy.maximum(numpy.percentile(profile, 90) - profile, 0)
+	return numpy.maximum(profile - numpy.percentile(profile, 10), 0)
+
+def profilePitch(signal, minimum=4):
+	''' distance of repeating peaks (lanes) from the autocorrelation '''
+	signal 	= signal - signal.mean()
+	size 	= 2 ** int(math.ceil(math.log(2*len(signal), 2)))
+	spectrum = numpy.fft.rfft(signal, size)
+	auto 	= numpy.fft.irfft(spectrum * numpy.conj(spectrum))[:len(signal)/2]
+	if len(auto) <= minimum:
+		return False
+	# first strong maximum after the autocorrelation went negative,
+	# later ones are multiples of the lane distance
+	negative = numpy.nonzero(auto[minimum:] < 0)[0]
+	if len(negative) == 0:
+		return False
+	start = minimum + negative[0]
+	peaks = findPeaks(auto[start:])
+	if len(peaks) == 0:
+		return False
+	strong = peaks[auto[start:][peaks] >= 0.5 * auto[start:][peaks].max()]
+	return start + int(strong[0])
+
+def findPeaks(signal, distance=1, threshold=0):
+	'''	indices of the local maxima higher than threshold, sorted.
+		Of peaks closer than distance only the highest is kept
+	'''
+	signal 	= numpy.asarray(signal, numpy.float64)
+	if len(signal) < 3:
+		return numpy.array([], int)
+	inner 	= signal[1:-1]
+	peaks 	= numpy.nonzero((inner > signal[:-2]) & (inner >= signal[2:]) & (inner > threshold))[0] + 1
+	if distance <= 1 or len(peaks) < 2:
+		return peaks
+	
+	# highest first, drop the neighbours of kept peaks
+	keep 		= numpy.zeros(len(signal), bool)
+	blocked 	= numpy.zeros(len(signal), bool)
+	for peak in peaks[numpy.argsort(-signal[peaks], kind='mergesort')]:
+		if not blocked[peak]:
+			keep[peak] = True
+			blocked[max(0, peak-distance+1):peak+distance] = True
+	return numpy.nonzero(keep)[0]
+
+def halfHeightCentres(signal, peaks):
+	'''	centres of the peaks as the middle of the part above half height,
+		with the crossings interpolated. A peak does not reach past the
+		lowest point between it and its neighbours or past the ends of
+		the signal. Flat peaks are found at their first sample, so the
+		middle between two peaks would cut off the wider right half
+	'''
+	if len(peaks) == 0:
+		return numpy.array([])
+	valleys = [a + int(numpy.argmin(signal[a:b+1])) for a, b in zip(peaks[:-1], peaks[1:])]
+	bounds 	= numpy.concatenate(([0], valleys, [len(signal)-1])).astype(int)
+	centres = []
+	for i, peak in enumerate(peaks):
+		half 	= signal[peak] / 2
+		left 	= peak
+		while left > bounds[i] and signal[left-1] > half:
+			left -= 1
+		right 	= peak
+		while right < bounds[i+1] and signal[right+1] > half:
+			right += 1
+		if left > bounds[i]:
+			left = left - (signal[left] - half) / (signal[left] - signal[left-1])
+		if right < bounds[i+1]:
+			right = right + (signal[right] - half) / (signal[right] - signal[right+1])
+		centres.append((left + right) / 2.0)
+	return numpy.array(centres)
+
+def findLanes(profile, dark=True, pitch=False, threshold=0.15):
+	'''	lane centres in a column projection of the gel.
+		The lane distance is taken from the autocorrelation if not given,
+		lanes weaker than threshold times the strongest lane are ignored
+	'''
+	signal = profileSignal(profile, dark)
+	if pitch is False:
+		pitch = profilePitch(smoothProfile(signal, 3)) or max(4, len(signal)/50)
+	signal 	= smoothProfile(signal, max(1, pitch/4))
+	peaks 	= findPeaks(signal, max(2, int(pitch*0.6)), signal.max() * threshold)
+	
+	# lanes have flat tops
+	return halfHeightCentres(signal, peaks)
+
+
+def findBands(profile, count=False, dark=True, samples=1024):
+	'''	positions of the count strongest bands in a profile along a lane
+		(all clear bands without count), sorted from the top. The peaks are
+		found on a downsampled profile and then refined at full resolution
+	'''
+	signal 	= profileSignal(profile, dark)
+	factor 	= max(1, len(signal) / samples)
+	size 	= len(signal) / factor * factor
+	coarse 	= signal[:size].reshape(-1, factor).mean(axis=1)
+	coarse 	= smoothProfile(coarse, 3)
+	if count is False:
+		peaks = findPeaks(coarse, 2, coarse.max() * 0.15)
+	else:
+		peaks = findPeaks(coarse, 2, coarse.max() * 0.05)
+	if len(peaks) == 0 or coarse.max() == 0:
+		return numpy.array([])
+	
+	# the strongest, then in order along the lane
+	if count is not False:
+		peaks = numpy.sort(peaks[numpy.argsort(-coarse[peaks], kind='mergesort')[:count]])
+	
+	# the highest full resolution sample inside the coarse peak and its neighbours
+	offsets = numpy.arange(-factor, 2*factor)
+	window 	= numpy.clip(peaks[:, numpy.newaxis] * factor + offsets, 0, len(signal)-1)
+	best 	= window[numpy.arange(len(peaks)), numpy.argmax(signal[window], axis=1)]
+	
+	# bands can be saturated and flat
+	return halfHeightCentres(signal, best)
+
+
+
+
+class LadderCalibration(object):
+	'''	Relation between the position on the gel and the fragment size,
+		fitted on the bands of a ladder. log10(size) is modelled as
+		
+		"loglinear": a straight line, least squares
+		"piecewise": straight lines between the bands
+		"spline": a monotone cubic through the bands
+		
+		Outside of the bands the piecewise and spline models continue
+		with the slope of the outer segments. positions() and sizes()
+		take numpy arrays and evaluate them all at once.
+	'''
+	def __init__(self, sizes, positions, kind="loglinear"):
+		if len(sizes) != len(positions) or len(sizes) < 2:
+			raise ValueError("a calibration needs at least two bands")
+		order 			= numpy.argsort(positions, kind='mergesort')
+		self.positions 	= numpy.asarray(positions, numpy.float64)[order]
+		self.logSizes 	= numpy.log10(numpy.asarray(sizes, numpy.float64))[order]
+		self.kind 		= kind
+		# a double click puts two bands at one place, no model fits that
+		same = numpy.nonzero(numpy.diff(self.positions) == 0)[0]
+		if len(same) > 0:
+			raise ValueError("two ladder bands are at the same position (%g), remove one of them" % self.positions[same[0]])
+		if kind == "loglinear" or len(sizes) == 2:
+			self.m, self.n = numpy.polyfit(self.positions, self.logSizes, 1)
+		elif kind == "spline":
+			self.slopes = self.hermiteSlopes()
+		elif kind != "piecewise":
+			raise ValueError("unknown calibration: %s" % kind)
+	
+	@classmethod
+	def fromLadder(cls, fragments, start, stop, bands, kind="loglinear"):
+		'''	from a drawn ladder: the clicked bands are the largest fragments.
+			Without two bands, the labels from start to stop span the ladder
+		'''
+		fragments = sorted(fragments, reverse=True)
+		if len(bands) >= 2:
+			count = min(len(bands), len(fragments))
+			return cls(fragments[:count], [band[1] for band in bands[:count]], kind)
+		return cls([fragments[0], fragments[-1]], [start[1], stop[1]], "loglinear")
+	
+	def hermiteSlopes(self):
+		''' slopes at the bands for a monotone cubic (Fritsch-Carlson) '''
+		delta 	= numpy.diff(self.logSizes) / numpy.diff(self.positions)
+		slopes 	= numpy.empty(len(self.positions))
+		slopes[0] 		= delta[0]
+		slopes[-1] 		= delta[-1]
+		slopes[1:-1] 	= (delta[:-1] + delta[1:]) / 2
+		# flat where the direction changes, limited to keep it monotone
+		slopes[1:-1][delta[:-1] * delta[1:] <= 0] = 0
+		for i in numpy.nonzero(delta == 0)[0]:
+			slopes[i] = slopes[i+1] = 0
+		ratio = numpy.hypot(slopes[:-1], slopes[1:]) / numpy.where(delta == 0, 1, numpy.abs(delta))
+		scale = numpy.where(ratio > 3, 3 / numpy.maximum(ratio, 1e-12), 1)
+		slopes[:-1] *= numpy.minimum(scale, numpy.r_[1, scale[:-1]])
+		slopes[1:] 	*= numpy.minimum(scale, numpy.r_[scale[1:], 1])
+		return slopes
+	
+	def logSize(self, positions):
+		positions = numpy.asarray(positions, numpy.float64)
+		if self.kind == "loglinear" or len(self.positions) == 2:
+			return self.m * positions + self.n
+		
+		# segment of every position, the outer segments are extended
+		segment = numpy.clip(numpy.searchsorted(self.positions, positions) - 1, 0, len(self.positions) - 2)
+		x0 		= self.positions[segment]
+		width 	= self.positions[segment+1] - x0
+		y0 		= self.logSizes[segment]
+		y1 		= self.logSizes[segment+1]
+		if self.kind == "piecewise":
+			return y0 + (y1 - y0) * (positions - x0) / width
+		
+		t 		= (positions - x0) / width
+		inside 	= (t >= 0) & (t <= 1)
+		t 		= numpy.clip(t, 0, 1)
+		d0 		= self.slopes[segment] * width
+		d1 		= self.slopes[segment+1] * width
+		cubic 	= ((2*t**3 - 3*t**2 + 1) * y0 + (t**3 - 2*t**2 + t) * d0 +
+				   (-2*t**3 + 3*t**2) * y1 + (t**3 - t**2) * d1)
+		# straight on outside of the bands
+		outer 	= numpy.where(positions < x0, self.slopes[0] * (positions - self.positions[0]) + self.logSizes[0],
+							  self.slopes[-1] * (positions - self.positions[-1]) + self.logSizes[-1])
+		return numpy.where(inside, cubic, outer)
+	
+	def sizes(self, positions):
+		''' fragment sizes at the positions '''
+		return 10 ** self.logSize(positions)
+	
+	def position(self, size):
+		''' position of a fragment size, the inverse of sizes() '''
+		logSize = math.log10(size)
+		if self.kind == "loglinear" or len(self.positions) == 2:
+			if self.m == 0:
+				return self.positions[0]
+			return (logSize - self.n) / self.m
+		# bisection between generous bounds, the models are monotone
+		span 	= self.positions[-1] - self.positions[0]
+		low 	= self.positions[0] - 10 * span
+		high 	= self.positions[-1] + 10 * span
+		falling = self.logSizes[-1] < self.logSizes[0]
+		for i in range(60):
+			middle = (low + high) / 2
+			if (self.logSize(middle) > logSize) == falling:
+				low = middle
+			else:
+				high = middle
+		return (low + high) / 2
+
+
+
+# tiff field types we need: (struct format, size)
+TIFF_TYPES = {1: ("B", 1), 3: ("H", 2), 4: ("I", 4)}
+
+class TiffFile(object):
+	'''	Reads uncompressed 8 and 16 bit tiff files through a memory map.
+		Nothing is read when the file is opened, read() returns the pixels
+		of a region and only touches the strips or tiles inside it.
+		If the strips are stored one after another (the usual case) the
+		whole image is a single view on the memory map, otherwise the
+		file can be sliced like an array.
+		
+		Other tiff files raise a ValueError, they are opened with wx.
+	'''
+	def __init__(self, path):
+		self.path = path
+		f = open(path, "rb")
+		try:
+			header = f.read(8)
+			if header[:2] == "II":
+				self.order = "<"
+			elif header[:2] == "MM":
+				self.order = ">"
+			else:
+				raise ValueError("%s is not a tiff file" % path)
+			magic, offset = struct.unpack(self.order + "HI", header[2:8])
+			if magic != 42:
+				raise ValueError("%s: only classic tiff files are supported" % path)
+			tags = self.readTags(f, offset)
+		finally:
+			f.close()
+		
+		self.width 			= tags[256][0]
+		self.height 		= tags[257][0]
+		bits 				= tags.get(258, (1,))
+		self.bits 			= bits[0]
+		self.samples 		= tags.get(277, (1,))[0]
+		self.photometric 	= tags.get(262, (1,))[0]
+		if tags.get(259, (1,))[0] != 1:
+			raise ValueError("%s is compressed" % path)
+		if self.bits not in (8, 16) or len(set(bits)) != 1 or tags.get(339, (1,))[0] != 1:
+			raise ValueError("%s: only 8 and 16 bit unsigned samples are supported" % path)
+		if self.samples > 1 and tags.get(284, (1,))[0] != 1:
+			raise ValueError("%s: planar tiff files are not supported" % path)
+		if self.photometric not in (0, 1, 2):
+			raise ValueError("%s: only gray and rgb tiff files are supported" % path)
+		
+		self.dtype 	= numpy.dtype(self.order + {8: "u1", 16: "u2"}[self.bits])
+		self.map 	= numpy.memmap(path, dtype=numpy.uint8, mode="r")
+		
+		if 322 in tags:
+			# tiled tiff
+			self.chunkWidth 	= tags[322][0]
+			self.chunkHeight 	= tags[323][0]
+			offsets 			= tags[324]
+		else:
+			self.chunkWidth 	= self.width
+			self.chunkHeight 	= min(tags.get(278, (self.height,))[0], self.height)
+			offsets 			= tags[273]
+		self.columns 	= (self.width + self.chunkWidth - 1) / self.chunkWidth
+		self.offsets 	= offsets
+		
+		# strips one after another: one view for the whole image
+		self.array = False
+		chunkSize = self.chunkWidth * self.chunkHeight * self.samples * self.dtype.itemsize
+		if 322 not in tags and all(offsets[i+1] - offsets[i] == chunkSize for i in range(len(offsets)-1)):
+			size = self.width * self.height * self.samples * self.dtype.itemsize
+			self.array = self.map[offsets[0]:offsets[0]+size].view(self.dtype).reshape(self.height, self.width, self.samples)
+	
+	def readTags(self, f, offset):
+		f.seek(offset)
+		count 	= struct.unpack(self.order + "H", f.read(2))[0]
+		entries = f.read(12*count)
+		tags 	= {}
+		for i in range(count):
+			entry = entries[i*12:(i+1)*12]
+			tag, fieldType, n = struct.unpack(self.order + "HHI", entry[:8])
+			if fieldType not in TIFF_TYPES:
+				continue
+			fmt, size = TIFF_TYPES[fieldType]
+			if n*size <= 4:
+				data = entry[8:8+n*size]
+			else:
+				f.seek(struct.unpack(self.order + "I", entry[8:])[0])
+				data = f.read(n*size)
+			tags[tag] = struct.unpack("%s%d%s" % (self.order, n, fmt), data)
+		return tags
+	
+	def chunk(self, index):
+		''' a strip or tile as (rows, columns, samples) view on the memory map '''
+		shape 	= (self.chunkHeight, self.chunkWidth, self.samples)
+		start 	= self.offsets[index]
+		size 	= shape[0] * shape[1] * shape[2] * self.dtype.itemsize
+		data 	= self.map[start:start+size]
+		if len(data) < size:
+			# the last strip can be shorter
+			rows 	= len(data) / (shape[1] * shape[2] * self.dtype.itemsize)
+			shape 	= (rows, shape[1], shape[2])
+			data 	= data[:rows * shape[1] * shape[2] * self.dtype.itemsize]
+		return data.view(self.dtype).reshape(shape)
+	
+	def read(self, x=0, y=0, width=False, height=False, step=1):
+		'''	the raw pixels of a region as (height, width, samples) array,
+			every step-th pixel of every step-th row. For contiguous strips
+			this is a view on the memory map. Strips or tiles without one
+			of these rows and columns are not read
+		'''
+		if width is False:
+			width = self.width - x
+		if height is False:
+			height = self.height - y
+		if self.array is not False:
+			return self.array[y:y+height:step, x:x+width:step]
+		
+		region = numpy.empty(((height + step - 1) / step, (width + step - 1) / step, self.samples), self.dtype)
+		for row in range(y / self.chunkHeight, (y + height - 1) / self.chunkHeight + 1):
+			for column in range(x / self.chunkWidth, (x + width - 1) / self.chunkWidth + 1):
+				top 	= row * self.chunkHeight
+				left 	= column * self.chunkWidth
+				
+				# first sampled row and column inside the chunk and the region
+				y1 = y + (max(y, top) - y + step - 1) / step * step
+				x1 = x + (max(x, left) - x + step - 1) / step * step
+				y2 = min(y + height, top + self.chunkHeight, self.height)
+				x2 = min(x + width, left + self.chunkWidth, self.width)
+				if y2 <= y1 or x2 <= x1:
+					continue
+				chunk 	= self.chunk(row * self.columns + column)
+				y2 		= min(y2, top + chunk.shape[0])
+				x2 		= min(x2, left + chunk.shape[1])
+				if y2 > y1 and x2 > x1:
+					region[(y1-y)/step:(y2-1-y)/step+1, (x1-x)/step:(x2-1-x)/step+1] = chunk[y1-top:y2-top:step, x1-left:x2-left:step]
+		return region
+	
+	def sample(self, step):
+		''' every step-th pixel of every step-th row, as a small copy '''
+		return numpy.ascontiguousarray(self.read(step=step))
+	
+	def view(self):
+		'''	the whole image without reading it: the memory map for
+			contiguous strips, otherwise the file itself, which reads
+			only the region of a slice
+		'''
+		if self.array is not False:
+			return self.array
+		return self
+	
+	@property
+	def shape(self):
+		return (self.height, self.width, self.samples)
+	
+	def __getitem__(self, index):
+		'''	tiff[rows, columns, samples] like a numpy array, rows and
+			columns have to be slices. Only the region is read
+		'''
+		if not isinstance(index, tuple):
+			index = (index,)
+		index 			= index + (slice(None),) * (2 - len(index))
+		y1, y2, yStep 	= index[0].indices(self.height)
+		x1, x2, xStep 	= index[1].indices(self.width)
+		if yStep == xStep:
+			region = self.read(x1, y1, max(0, x2 - x1), max(0, y2 - y1), yStep)
+		else:
+			region = self.read(x1, y1, max(0, x2 - x1), max(0, y2 - y1))[::yStep, ::xStep]
+		return region[(slice(None), slice(None)) + index[2:]]
+
+
+
+class TileCache(object):
+	'''	LRU cache of image tiles.
+		Tiles are stored by (level, column, row), the least recently used
+		ones are thrown away as soon as the memory budget is exceeded.
+	'''
+	def __init__(self, budget=TILE_CACHE_MB*1024*1024):
+		self.budget = budget
+		self.tiles 	= collections.OrderedDict()
+		self.size 	= 0
+		
+		self.hits 		= 0
+		self.misses 	= 0
+		self.evictions 	= 0
+	
+	def clear(self):
+		self.tiles 	= collections.OrderedDict()
+		self.size 	= 0
+	
+	def setBudget(self, budget):
+		self.budget = budget
+		self.shrink()
+	
+	def get(self, key):
+		tile = self.tiles.pop(key, False)
+		if tile is False:
+			self.misses = self.misses + 1
+			return False
+		
+		# put it back at the end, it is the most recent one now
+		self.tiles[key] = tile
+		self.hits = self.hits + 1
+		return tile
+	
+	def put(self, key, tile):
+		self.tiles[key] = tile
+		self.size 		= self.size + tile.get_stride() * tile.get_height()
+		self.shrink()
+	
+	def shrink(self):
+		while self.size > self.budget and len(self.tiles) > 1:
+			key, tile 	= self.tiles.popitem(last=False)
+			self.size 	= self.size - tile.get_stride() * tile.get_height()
+			self.evictions = self.evictions + 1
+	
+	def stats(self):
+		return {"tiles": len(self.tiles), "bytes": self.size, "hits": self.hits,
+				"misses": self.misses, "evictions": self.evictions}
+
+
+
+class LayoutCache(object):
+	'''	LRU cache of text layouts, counted in entries.
+		The keys hold everything the layout depends on (text, font,
+		size, ...), so entries never have to be invalidated.
+	'''
+	def __init__(self, limit=512):
+		self.limit 		= limit
+		self.entries 	= collections.OrderedDict()
+		
+		self.hits 		= 0
+		self.misses 	= 0
+	
+	def clear(self):
+		self.entries = collections.OrderedDict()
+	
+	def get(self, key):
+		entry = self.entries.pop(key, False)
+		if entry is False:
+			self.misses = self.misses + 1
+			return False
+		self.entries[key] = entry
+		self.hits = self.hits + 1
+		return entry
+	
+	def put(self, key, entry):
+		self.entries[key] = entry
+		while len(self.entries) > self.limit:
+			self.entries.popitem(last=False)
+	
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+				"hitRate": float(self.hits) / lookups if lookups else 0.0}
+
+
+
+class SpatialGrid(object):
+	'''	Uniform grid of boxes (x1, y1, x2, y2) for hit testing.
+		Every box is stored in the cells it touches, a point only
+		checks the boxes of its own cell. Boxes that would cover
+		too many cells are kept aside and always checked.
+	'''
+	def __init__(self, cell=64.0, maxCells=1024):
+		self.cell 		= float(cell)
+		self.maxCells 	= maxCells
+		self.cells 		= {}
+		self.boxes 		= []
+		self.large 		= []
+	
+	@classmethod
+	def fromBoxes(cls, items):
+		''' grid for (item, box) pairs, the cells are about as large as a typical box '''
+		sizes = sorted(max(box[2]-box[0], box[3]-box[1]) for item, box in items)
+		cell = 64.0
+		if len(sizes) > 0 and sizes[len(sizes)/2] > 0:
+			cell = sizes[len(sizes)/2]
+		grid = cls(cell)
+		for item, box in items:
+			grid.insert(item, box)
+		return grid
+	
+	def insert(self, item, box):
+		index = len(self.boxes)
+		self.boxes.append((item, box))
+		x1, y1, x2, y2 = [int(math.floor(v / self.cell)) for v in box]
+		if (x2-x1+1) * (y2-y1+1) > self.maxCells:
+			self.large.append(index)
+			return
+		for cx in range(x1, x2+1):
+			for cy in range(y1, y2+1):
+				self.cells.setdefault((cx, cy), []).append(index)
+	
+	def query(self, x, y):
+		''' items of the boxes around the point, the last inserted first '''
+		cell 	= (int(math.floor(x / self.cell)), int(math.floor(y / self.cell)))
+		hits 	= []
+		for index in sorted(self.cells.get(cell, []) + self.large, reverse=True):
+			item, box = self.boxes[index]
+			if box[0] <= x <= box[2] and box[1] <= y <= box[3] and item not in hits:
+				hits.append(item)
+		return hits
+
+def pointInPolygon(x, y, points):
+	''' is the point inside the polygon (even-odd rule)? '''
+	inside 	= False
+	x1, y1 	= points[-1]
+	for x2, y2 in points:
+		if (y1 > y) != (y2 > y) and x < x1 + float(y - y1) * (x2 - x1) / (y2 - y1):
+			inside = not inside
+		x1, y1 = x2, y2
+	return inside
+
+def segmentDistance(x, y, a, b):
+	''' distance of the point to the line segment from a to b '''
+	dx, dy 	= b[0] - a[0], b[1] - a[1]
+	length 	= dx*dx + dy*dy
+	t 		= 0.0
+	if length > 0:
+		t = min(1.0, max(0.0, float((x - a[0]) * dx + (y - a[1]) * dy) / length))
+	return math.hypot(x - a[0] - t*dx, y - a[1] - t*dy)
+
+def shapeHit(shape, x, y):
+	'''	exact test of a part recorded by markBounds or markStroke,
+		all in device space
+	'''
+	if shape[0] == "quad":
+		return pointInPolygon(x, y, shape[1])
+	points, radius = shape[1], shape[2]
+	return any(segmentDistance(x, y, points[i], points[i+1]) <= radius for i in range(len(points)-1))
+
+
+
+class ImageCache(object):
+	'''	Keeps the cairo surface of the loaded image around,
+		so a repaint does not have to touch the pixels again.
+		invalidate() has to be called for a new image, changed() when
+		the pixels of the image were changed.
+		
+		For zoomed out views a pyramid of halved surfaces is kept.
+		Levels are only made when they are needed for the first time.
+		
+		If the image is cropped, level 0 is still the full surface, only
+		an offset is used. The smaller levels and the tiles are made from
+		the cropped part alone.
+	'''
+	def __init__(self):
+		self.pixels 	= False	# PixelBuffer
+		self.surface 	= False
+		self.levels 	= []	# level 0 is the full resolution
+		self.tiles 		= TileCache()
+		self.version 	= 0		# changes with every change of the pixels
+		self.crop 		= False	# (x, y, width, height) in pixels of the image
+		
+		# pixels of the buffer per pixel of the image (x, y), smaller
+		# than 1 for a preview. The crop is scaled by it
+		self.scale 		= (1, 1)
+		self.bufferCrop = False
+		
+		# counters, to see if redraws touch the pixel data
+		self.hits 		= 0
+		self.misses 	= 0
+	
+	def invalidate(self, pixels=False, scale=(1, 1)):
+		self.pixels 	= pixels
+		self.scale 		= scale
+		self.bufferCrop = self.scaleCrop(self.crop)
+		self.surface 	= False
+		self.levels 	= []
+		self.tiles.clear()
+		self.version 	= self.version + 1
+	
+	def changed(self):
+		''' the pixels were changed in place, level 0 shares their memory '''
+		self.levels 	= self.levels[:1]
+		self.tiles.clear()
+		self.version 	= self.version + 1
+	
+	def setCrop(self, crop):
+		if crop == self.crop:
+			return
+		self.crop 		= crop
+		self.bufferCrop = self.scaleCrop(crop)
+		self.levels 	= self.levels[:1]
+		self.tiles.clear()
+		self.version 	= self.version + 1
+	
+	def scaleCrop(self, crop):
+		if crop == False or self.scale == (1, 1):
+			return crop
+		sx, sy 	= self.scale
+		x, y 	= int(crop[0] * sx), int(crop[1] * sy)
+		return (x, y, max(1, int(math.ceil((crop[0] + crop[2]) * sx)) - x),
+				max(1, int(math.ceil((crop[1] + crop[3]) * sy)) - y))
+	
+	def levelSize(self, level):
+		if level == 0 and self.bufferCrop != False:
+			return self.bufferCrop[2], self.bufferCrop[3]
+		surface = self.getLevel(level)
+		return surface.get_width(), surface.get_height()
+	
+	def levelOrigin(self, level):
+		''' offset of the (cropped) image inside the surface of a level '''
+		if level == 0 and self.bufferCrop != False:
+			return self.bufferCrop[0], self.bufferCrop[1]
+		return 0, 0
+	
+	def getCropped(self, copy=False):
+		'''	a surface with only the cropped pixels, to embed in exports.
+			With copy, it is never the cached surface itself
+		'''
+		surface = self.getSurface()
+		if surface is False:
+			return surface
+		x, y 			= self.levelOrigin(0)
+		width, height 	= self.levelSize(0)
+		self.pixels.showRows(y, y + height)
+		if self.bufferCrop == False and copy == False:
+			return surface
+		cropped = cairo.ImageSurface(surface.get_format(), width, height)
+		ctx 	= cairo.Context(cropped)
+		ctx.set_source_surface(surface, -x, -y)
+		ctx.paint()
+		return cropped
+	
+	def getSurface(self):
+		if self.surface is False:
+			self.misses = self.misses + 1
+			if self.pixels is False:
+				return False
+			self.surface = self.pixels.getSurface()
+			self.levels  = [self.surface]
+		else:
+			self.hits = self.hits + 1
+		return self.surface
+	
+	def levelFor(self, zoom, screenWidth, screenHeight):
+		'''	returns the smallest level that has at least as many pixels
+			as needed for this zoom. We stop halving as soon as a level
+			fits on the screen.
+		'''
+		surface = self.getSurface()
+		if surface is False:
+			return 0
+		
+		level 			= 0
+		width, height 	= self.levelSize(0)
+		zoom 			= zoom / self.scale[0]
+		while zoom <= 0.5 ** (level+1) and (width > screenWidth or height > screenHeight):
+			level 	= level + 1
+			width 	= max(1, width/2)
+			height 	= max(1, height/2)
+		return level
+	
+	def getLevel(self, level):
+		if level == 0:
+			return self.getSurface()
+		
+		if level < len(self.levels) and self.levels[level] is not False:
+			self.hits = self.hits + 1
+			return self.levels[level]
+		
+		if self.getSurface() is False:
+			return False
+		self.misses = self.misses + 1
+		if self.pixels.pending is not False:
+			# the pixels are not all made yet, halving would make them.
+			# Only every n-th pixel of the raw data is read instead
+			x, y 			= self.levelOrigin(0)
+			width, height 	= self.levelSize(0)
+			surface = self.pixels.sampled(x, y, width, height, 2 ** level)
+		else:
+			# build the missing levels from the one above
+			previous = self.getLevel(level-1)
+			surface = self.halve(previous, self.levelOrigin(level-1), self.levelSize(level-1))
+		self.levels.extend([False] * (level + 1 - len(self.levels)))
+		self.levels[level] = surface
+		return surface
+	
+	def halve(self, source, origin, size):
+		width 	= max(1, size[0]/2)
+		height 	= max(1, size[1]/2)
+		surface = cairo.ImageSurface(source.get_format(), width, height)
+		
+		ctx 	= cairo.Context(surface)
+		ctx.scale(float(width)/size[0], float(height)/size[1])
+		ctx.set_source_surface(source, -origin[0], -origin[1])
+		ctx.get_source().set_filter(cairo.FILTER_GOOD)
+		ctx.paint()
+		return surface
+	
+	def getTile(self, level, column, row):
+		key 	= (level, column, row)
+		tile 	= self.tiles.get(key)
+		if tile is not False:
+			return tile
+		
+		source 	= self.getLevel(level)
+		ox, oy 	= self.levelOrigin(level)
+		size 	= self.levelSize(level)
+		x 		= column * TILE_SIZE
+		y 		= row * TILE_SIZE
+		width 	= min(TILE_SIZE, size[0] - x)
+		height 	= min(TILE_SIZE, size[1] - y)
+		if level == 0:
+			self.pixels.showRows(oy + y, oy + y + height)
+		
+		tile 	= cairo.ImageSurface(source.get_format(), width, height)
+		ctx 	= cairo.Context(tile)
+		ctx.set_source_surface(source, -ox-x, -oy-y)
+		ctx.paint()
+		
+		self.tiles.put(key, tile)
+		return tile
+	
+	def paintLevel(self, cr, level):
+		'''	paints the tiles of a level which are inside the clip of cr.
+			cr has to be transformed so that one unit is one pixel of the level.
+		'''
+		source = self.getLevel(level)
+		if source is False:
+			return 0
+		width, height = self.levelSize(level)
+		
+		# visible part of the image
+		x1, y1, x2, y2 = cr.clip_extents()
+		x1 = max(0, int(math.floor(x1)))
+		y1 = max(0, int(math.floor(y1)))
+		x2 = min(width, int(math.ceil(x2)))
+		y2 = min(height, int(math.ceil(y2)))
+		if x2 <= x1 or y2 <= y1:
+			return 0
+		
+		painted = 0
+		for row in range(y1/TILE_SIZE, (y2-1)/TILE_SIZE + 1):
+			for column in range(x1/TILE_SIZE, (x2-1)/TILE_SIZE + 1):
+				tile 	= self.getTile(level, column, row)
+				x 		= column * TILE_SIZE
+				y 		= row * TILE_SIZE
+				
+				# tiles overlap by one pixel, so no seams are visible
+				# when the image is scaled or rotated
+				w = tile.get_width()
+				h = tile.get_height()
+				if x + w < width:
+					w = w + 1
+				if y + h < height:
+					h = h + 1
+				
+				pattern = cairo.SurfacePattern(tile)
+				pattern.set_extend(cairo.EXTEND_PAD)
+				pattern.set_matrix(cairo.Matrix(x0=-x, y0=-y))
+				cr.set_source(pattern)
+				cr.rectangle(x, y, w, h)
+				cr.fill()
+				painted = painted + 1
+		return painted
+	
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "levels": len(self.levels) - self.levels.count(False),
+				"tiles": self.tiles.stats()}
+
+
+
+
+
+
+
+class RedrawScheduler(object):
+	'''	Collects redraw requests of mouse events and renders at most
+		once per frame. The state is changed by the events directly, so
+		a frame always shows the latest one, requests in between are
+		coalesced.
+	'''
+	def __init__(self, callback, fps=REDRAW_FPS):
+		self.callback 	= callback
+		self.pending 	= False
+		self.timer 		= False
+		self.lastFrame 	= 0
+		self.setFps(fps)
+		
+		# to tune the frame rate
+		self.frames 	= 0
+		self.coalesced 	= 0		# requests merged into a pending frame
+		self.dropped 	= 0		# frames lost because drawing was too slow
+	
+	def setFps(self, fps):
+		self.fps 		= fps
+		self.interval 	= 1.0/fps
+	
+	def request(self):
+		if self.pending:
+			self.coalesced = self.coalesced + 1
+			return
+		self.pending = True
+		
+		wait = self.lastFrame + self.interval - time.time()
+		if wait <= 0:
+			# draw as soon as the event queue is empty
+			wx.CallAfter(self.render)
+		else:
+			self.timer = wx.CallLater(int(math.ceil(wait*1000)), self.render)
+	
+	def cancel(self):
+		''' called if the drawing was updated directly '''
+		self.pending = False
+		if self.timer is not False:
+			self.timer.Stop()
+			self.timer = False
+	
+	def render(self):
+		self.timer = False
+		if self.pending == False:
+			return
+		self.pending = False
+		
+		start = time.time()
+		self.callback()
+		elapsed = time.time() - start
+		
+		self.lastFrame 	= start
+		self.frames 	= self.frames + 1
+		if elapsed > self.interval:
+			self.dropped = self.dropped + int(elapsed/self.interval)
+	
+	def stats(self):
+		return {"fps": self.fps, "frames": self.frames,
+				"coalesced": self.coalesced, "dropped": self.dropped}
+
+class LoadCancelled(Exception):
+	pass
+
+class ImageLoader(object):
+	'''	Reads an image on a worker thread. preview() returns a small
+		version right away: every n-th pixel of an uncompressed tiff,
+		a reduced jpeg decode (with PIL) or a gray placeholder. done is
+		called on the main thread with the loader when the full image is
+		read, progress with the done fraction. A cancelled loader never
+		calls them.
+	'''
+	def __init__(self, path, imageType, done, progress=False):
+		self.path 		= path
+		self.imageType 	= imageType
+		self.done 		= done
+		self.progress 	= progress
+		self.width 		= False
+		self.height 	= False
+		self.tiff 		= False
+		if imageType == wx.BITMAP_TYPE_TIF:
+			try:
+				self.tiff = TiffFile(path)
+			except ValueError:
+				pass
+		
+		self.pixels 	= False
+		self.imageHash 	= False
+		self.error 		= False
+		self.cancelled 	= False
+		self.finished 	= False
+		self.percent 	= -1
+		self.thread 	= False
+	
+	def preview(self):
+		'''	a small PixelBuffer to show until the image is read, or False
+			if the image is small or its size is not known. Then it
+			should be read at once with run()
+		'''
+		if self.tiff is not False:
+			self.width, self.height = self.tiff.width, self.tiff.height
+		else:
+			size = imageSize(self.path)
+			if size is False:
+				return False
+			self.width, self.height = size
+		
+		step = int(math.ceil(max(self.width, self.height) / float(PREVIEW_SIZE)))
+		if step <= 1:
+			return False
+		if self.tiff is not False:
+			return PixelBuffer.previewTiff(self.tiff, step)
+		if JpegImagePlugin is not None and self.imageType == wx.BITMAP_TYPE_JPEG:
+			# Image.open of newer PIL versions checks the full size against
+			# the decompression bomb limit, the plugin itself does not. Only
+			# the small draft is decoded. If PIL can not read the file, the
+			# placeholder is shown until wx has read it
+			try:
+				image = JpegImagePlugin.JpegImageFile(self.path)
+				image.draft("RGB", (self.width / step, self.height / step))
+				return PixelBuffer.fromArray(numpy.asarray(image.convert("RGB")))
+			except Exception:
+				pass
+		
+		# the format can not be read at a lower resolution
+		pixels = PixelBuffer(1, 1)
+		pixels.rgb[...] = 200
+		return pixels
+	
+	def start(self):
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+	
+	def run(self):
+		try:
+			if self.tiff is not False:
+				self.pixels = PixelBuffer.fromTiff(self.tiff)
+			else:
+				self.pixels = PixelBuffer.fromWxImage(wx.Image(self.path, self.imageType))
+			self.report(1.0)
+			self.imageHash = fileHash(self.path)
+		except LoadCancelled:
+			return
+		except Exception as error:
+			self.error = error
+		if self.thread is not False:
+			wx.CallAfter(self.finish)
+	
+	def report(self, fraction):
+		''' called by the worker, stops it if the loader was cancelled '''
+		if self.cancelled:
+			raise LoadCancelled()
+		percent = int(fraction * 100)
+		if percent != self.percent and self.progress is not False:
+			self.percent = percent
+			if self.thread is not False:
+				wx.CallAfter(self.showProgress, percent)
+			else:
+				self.progress(percent)
+	
+	def showProgress(self, percent):
+		if not self.cancelled and not self.finished:
+			self.progress(percent)
+	
+	def cancel(self):
+		self.cancelled = True
+	
+	def wait(self):
+		''' blocks until the image is read, done is called before it returns '''
+		if self.thread is not False:
+			self.thread.join()
+		self.finish()
+	
+	def finish(self):
+		if self.cancelled or self.finished:
+			return
+		self.finished = True
+		self.done(self)
+
+
+
+
+
+
+
+# every change of a document gets a new number, also after copies
+DOCUMENT_VERSIONS = itertools.count(1)
+
+class Ladder(object):
+	'''	A ladder on the gel: the name of the ladder in LADDERS, start
+		and stop of its labels and the clicked bands, all in user space.
+		Ladders are not changed, the document replaces them by new ones.
+	'''
+	__slots__ = ("name", "start", "stop", "bands")
+	
+	def __init__(self, name, start, stop, bands=()):
+		self.name 	= name
+		self.start 	= (float(start[0]), float(start[1]))
+		self.stop 	= (float(stop[0]), float(stop[1]))
+		self.bands 	= tuple((float(x), float(y)) for x, y in bands)
+	
+	def withBands(self, bands):
+		return Ladder(self.name, self.start, self.stop, bands)
+	
+	def __eq__(self, other):
+		return (isinstance(other, Ladder) and self.name == other.name and self.start == other.start
+				and self.stop == other.stop and self.bands == other.bands)
+	
+	def __ne__(self, other):
+		return not self == other
+	
+	def __repr__(self):
+		return "Ladder(%r, %r, %r, %r)" % (self.name, self.start, self.stop, self.bands)
+
+class GelDocument(object):
+	'''	The annotations of a gel: ladders, lane markers, crop and export
+		range. All fields hold immutable values (tuples and Ladders), so
+		copy() only copies five references and shares everything else.
+		Every change goes through a method and gets a new version: the
+		undo history and the hit-test grid compare it to see if the
+		annotations changed.
+	'''
+	__slots__ = ("ladders", "laneMarkers", "crop", "export", "version")
+	
+	def __init__(self):
+		self.ladders 		= ()
+		self.laneMarkers 	= ()
+		self.crop 			= False		# ((x1, y1), (x2, y2)), the corners as dragged
+		self.export 		= False		# same for the export range
+		self.version 		= next(DOCUMENT_VERSIONS)
+	
+	def copy(self):
+		document = GelDocument.__new__(GelDocument)
+		for name in GelDocument.__slots__:
+			setattr(document, name, getattr(self, name))
+		return document
+	
+	def changed(self):
+		self.version = next(DOCUMENT_VERSIONS)
+	
+	# ladders
+	def addLadder(self, ladder):
+		self.ladders = self.ladders + (ladder,)
+		self.changed()
+	
+	def replaceLadder(self, index, ladder):
+		ladders 		= list(self.ladders)
+		ladders[index] 	= ladder
+		self.ladders 	= tuple(ladders)
+		self.changed()
+	
+	def removeLastLadder(self):
+		self.ladders = self.ladders[:-1]
+		self.changed()
+	
+	def removeLadders(self):
+		self.ladders = ()
+		self.changed()
+	
+	def setBands(self, index, bands):
+		self.replaceLadder(index, self.ladders[index].withBands(bands))
+	
+	def addBand(self, index, point):
+		self.setBands(index, self.ladders[index].bands + (point,))
+	
+	# lane markers
+	def addLaneMarker(self, point):
+		self.laneMarkers = self.laneMarkers + ((float(point[0]), float(point[1])),)
+		self.changed()
+	
+	def setLaneMarkers(self, points):
+		self.laneMarkers = tuple((float(x), float(y)) for x, y in points)
+		self.changed()
+	
+	# crop and export range
+	def setCrop(self, corners):
+		if corners != False:
+			corners = (tuple(corners[0]), tuple(corners[1]))
+		self.crop = corners
+		self.changed()
+	
+	def setExport(self, corners):
+		if corners != False:
+			corners = (tuple(corners[0]), tuple(corners[1]))
+		self.export = corners
+		self.changed()
+	
+	def sameAnnotations(self, other):
+		''' True if both have the same ladders, lane markers and crop '''
+		for name in ("ladders", "laneMarkers", "crop"):
+			mine, theirs = getattr(self, name), getattr(other, name)
+			if mine is not theirs and mine != theirs:
+				return False
+		return True
+
+class DocumentHistory(object):
+	'''	Undo and redo of a GelDocument. Every step is a copy() of the
+		document, which shares all ladders and markers with the steps
+		before it, so a step costs a few references. Only the last
+		HISTORY_LIMIT steps are kept. The export range is not a step.
+	'''
+	def __init__(self, document, limit=HISTORY_LIMIT):
+		self.present 	= document.copy()
+		self.past 		= collections.deque(maxlen=limit)
+		self.future 	= []
+	
+	def commit(self, document):
+		'''	makes the document a step, returns False if nothing changed
+			since the last one. Steps that were undone are dropped
+		'''
+		if document.version == self.present.version or document.sameAnnotations(self.present):
+			return False
+		self.past.append(self.present)
+		self.present 	= document.copy()
+		self.future 	= []
+		return True
+	
+	def canUndo(self):
+		return len(self.past) > 0
+	
+	def canRedo(self):
+		return len(self.future) > 0
+	
+	def jump(self, document, steps):
+		'''	the document some steps back (negative) or forward, as a
+			new copy. Changes not yet committed are committed first.
+			Returns False if there are not enough steps
+		'''
+		self.commit(document)
+		if (steps < 0 and -steps > len(self.past)) or (steps > 0 and steps > len(self.future)) or steps == 0:
+			return False
+		for i in range(-steps):
+			self.future.append(self.present)
+			self.present = self.past.pop()
+		for i in range(steps):
+			self.past.append(self.present)
+			self.present = self.future.pop()
+		return self.present.copy()
+	
+	def undo(self, document):
+		return self.jump(document, -1)
+	
+	def redo(self, document):
+		return self.jump(document, 1)
+	
+	def steps(self):
+		''' all documents from the oldest to the last redo, and the index of the present one '''
+		return list(self.past) + [self.present] + self.future[::-1], len(self.past)
+
+
+
+class GelPainter(object):
+	'''	The drawing code for the image and the annotations.
+		It only needs a cairo context in self.cr, so it is used by the
+		DrawingArea window as well as by HeadlessGel for batch rendering.
+	'''
+	def __init__(self):
+		self.imagePos 	= (0,0)
+		self.cropDragging = False	# crop is only previewed while dragging
+		self.drawExport = False
+		self.tempLadder = False		# the last ladder is still dragged
+		
+		# ladders, lane markers, crop and export range
+		self.document 	= GelDocument()
+		self.history 	= DocumentHistory(self.document)
+		
+		self.scroll		= (0,0)
+		self.zoom		= 1
+		
+		# cairo surface of the image, only rebuild if the image changes
+		self.imageCache = ImageCache()
+		
+		# label texts, positions and extents of the ladders
+		self.layoutCache = LayoutCache()
+		
+		# device space bounding boxes of the annotations, recorded while
+		# drawing. Small edits only redraw the boxes that changed
+		self.bounds 	= {}
+		
+		# the single parts (texts, lines) of the annotations, for hit testing:
+		# (key, device box, exact shape), and the view they were drawn in.
+		# overlayDraws counts the draws, the grid of the parts is made
+		# again for a new draw or a new document version
+		self.parts 			= []
+		self.partsMatrix 	= False
+		self.overlayDraws 	= 0
+		self.grid 			= False
+		self.gridKey 		= False
+		
+		# set while a svg file is written
+		self.svgFile 	= False
+		self.written 	= []
+	
+	def notify(self, text):
+		'''	tells the user about something that did not stop the work.
+			Without a window it goes to stderr
+		'''
+		print >> sys.stderr, text
+	
+	def canvasSize(self):
+		'''	size of the output in pixels: the crop, or the image, at the
+			current zoom. Windows and HeadlessGel size it themselves
+		'''
+		left, top, right, bottom = self.imageExtents()
+		return (int(math.ceil((right-left)*self.zoom)), int(math.ceil((bottom-top)*self.zoom)))
+	
+	def imageExtents(self):
+		'''	(left, top, right, bottom) in user space of the crop, or of the
+			rotated image. Without an image it is the origin
+		'''
+		box = self.activeCrop()
+		if box != False:
+			return box
+		if self.infos["file"] == False:
+			return (0, 0, 0, 0)
+		width 	= self.infos["imageWidth"]
+		height 	= self.infos["imageHeight"]
+		posx 	= self.imagePos[0] - width/2
+		posy 	= self.imagePos[1] - height/2
+		angle 	= self.infos["rotate"]
+		xs 		= []
+		ys 		= []
+		for x, y in ((posx, posy), (posx+width, posy), (posx, posy+height), (posx+width, posy+height)):
+			xs.append(x*math.cos(angle) - y*math.sin(angle))
+			ys.append(x*math.sin(angle) + y*math.cos(angle))
+		return (min(xs), min(ys), max(xs), max(ys))
+	
+	def projectState(self, basePath=""):
+		'''	everything needed to restore the annotated gel, as json values.
+			The keys are the same as in a spec file for HeadlessGel,
+			the image path is relative to basePath
+		'''
+		document = self.document
+		state = {	"gelProject": 1,
+					"image": False,
+					"imageHash": self.infos.get("imageHash", False),
+					"rotate": self.infos["rotate"],
+					"bakedRotate": self.infos.get("bakedRotate", 0),
+					"imagePos": list(self.imagePos),
+					"crop": [list(corner) for corner in document.crop] if document.crop != False else False,
+					"ladders": [{"name": ladder.name, "start": list(ladder.start), "stop": list(ladder.stop),
+								 "bands": [list(band) for band in ladder.bands]} for ladder in document.ladders],
+					"laneMarkers": [list(marker) for marker in document.laneMarkers],
+					"marks": self.infos["marks"],
+					"custommarks": list(self.infos.get("custommarks", [])),
+					"rotateLabel": self.infos["rotateLabel"],
+					"unit": self.infos.get("unit", UNITS[0]),
+					"font": fontSpec(self.infos)}
+		if self.infos["file"] != False:
+			state["image"] = os.path.relpath(self.infos["file"], basePath or os.curdir)
+		return state
+	
+	def applyProjectState(self, state):
+		'''	restores the annotations of projectState(), not the image.
+			A baked rotation is only noted, rotatePixels() has to put it
+			into the pixels of the image
+		'''
+		document = GelDocument()
+		if state.get("crop"):
+			document.setCrop(state["crop"])
+		for ladder in state.get("ladders", []):
+			document.addLadder(Ladder(ladder["name"], ladder["start"], ladder["stop"], ladder.get("bands", [])))
+		document.setLaneMarkers(state.get("laneMarkers", []))
+		
+		self.document 		= document
+		self.history 		= DocumentHistory(document)
+		self.imagePos 		= tuple(state.get("imagePos", (0,0)))
+		self.cropDragging 	= False
+		self.tempLadder 	= False
+		self.infos["rotate"] 		= state.get("rotate", 0)
+		self.infos["bakedRotate"] 	= state.get("bakedRotate", 0)
+		self.infos["marks"] 		= state.get("marks", "ABC")
+		self.infos["custommarks"] 	= list(state.get("custommarks", []))
+		self.infos["rotateLabel"] 	= state.get("rotateLabel", 0)
+		self.infos["unit"] 			= state.get("unit", UNITS[0])
+		self.infos.update(fontInfos(state.get("font", {})))
+		self.ladderFontSize = int(self.infos['fontsize'])
+	
+	def newDocument(self):
+		''' empty annotations, for a new image '''
+		self.document 		= GelDocument()
+		self.history 		= DocumentHistory(self.document)
+		self.imagePos 		= (0,0)
+		self.cropDragging 	= False
+		self.tempLadder 	= False
+	
+	def checkpoint(self):
+		''' the end of an edit, it can be undone from now on '''
+		return self.history.commit(self.document)
+	
+	def undo(self, steps=1):
+		''' goes back some edits, returns False if there are none '''
+		return self.useStep(self.history.jump(self.document, -steps))
+	
+	def redo(self, steps=1):
+		return self.useStep(self.history.jump(self.document, steps))
+	
+	def useStep(self, document):
+		if document is False:
+			return False
+		self.document 		= document
+		self.cropDragging 	= False
+		self.tempLadder 	= False
+		# bands can only be clicked if there is a ladder
+		if len(document.ladders) == 0 and self.infos["currentAction"] == "drawLadderLines":
+			self.infos["currentAction"] = False
+		return True
+	
+	def canvasExtents(self):
+		''' (left, top, right, bottom) of the output in user space '''
+		width, height = self.canvasSize()
+		return (-width/2, -height/2, width/2, height/2)
+	
+	def px2Dist(self, px):
+		return self.cr.device_to_user_distance(0,px)[1]
+	
+	def writeFile(self, filepath, extents, scale=1):
+		'''	renders the user space box extents (left, top, right, bottom)
+			to a svg, png or pdf file, depending on the extension.
+			One unit becomes scale pixels (or points)
+		'''
+		left, top, right, bottom = extents
+		width 		= max(1, int(math.ceil((right-left)*scale)))
+		height 		= max(1, int(math.ceil((bottom-top)*scale)))
+		fileType 	= os.path.splitext(filepath)[1].lower()
+		if fileType == ".svg":
+			surface = cairo.SVGSurface(filepath, width, height)
+		elif fileType == ".pdf":
+			surface = cairo.PDFSurface(filepath, width, height)
+		elif fileType == ".png":
+			if width > PNG_MAX_SIZE or height > PNG_MAX_SIZE:
+				raise ValueError("%s would be %dx%d pixels, png files can only be %d pixels wide and high"
+								% (filepath, width, height, PNG_MAX_SIZE))
+			surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+		else:
+			raise ValueError("unknown file type: %s" % filepath)
+		
+		# the window still needs its own context and bounds afterwards
+		cr 		= getattr(self, "cr", False)
+		bounds 	= self.bounds
+		parts 	= (self.parts, self.partsMatrix, self.overlayDraws)
+		
+		# svg files can store the image in different ways
+		self.written = [filepath]
+		if fileType == ".svg":
+			self.svgFile = filepath
+		else:
+			self.svgFile = False
+		
+		try:
+			self.cr = cairo.Context(surface)
+			if fileType == ".png":
+				self.cr.set_source_rgb(1,1,1)
+				self.cr.paint()
+			
+			self.cr.scale(scale, scale)
+			self.cr.translate(-left, -top)
+			self.cr.rectangle(left, top, right-left, bottom-top)
+			self.cr.clip()
+			
+			self.openFile(tiled=False)
+			self.drawOverlay()
+			
+			if fileType == ".png":
+				surface.write_to_png(filepath)
+			surface.finish()
+		finally:
+			# also if the export failed
+			self.cr 	= cr
+			self.bounds = bounds
+			self.parts, self.partsMatrix, self.overlayDraws = parts
+			self.overlayDraws = self.overlayDraws + 1 	# the grid may hold the parts of the export
+		return self.written
+	
+	def exportImage(self):
+		'''	returns the cropped image for an export and the factor it has to
+			be scaled by. For svg files the image is encoded like
+			infos["svgImage"] says: as png, as jpeg with a quality,
+			downsampled, or as link to an extra png file
+		'''
+		if self.svgFile == False:
+			return self.imageCache.getCropped(), 1
+		
+		options = dict(SVG_IMAGE)
+		options.update(self.infos.get("svgImage", {}))
+		codec 	= options["codec"]
+		
+		# pycairo before 1.12 can not attach mime data to surfaces
+		if codec in ("jpeg", "link") and not (hasattr(cairo.ImageSurface, "set_mime_data") and hasattr(cairo, "MIME_TYPE_JPEG") and hasattr(cairo, "MIME_TYPE_URI")):
+			self.notify("svg image codec %s needs pycairo 1.12, the image is embedded as png" % codec)
+			codec = "png"
+		
+		if codec == "png":
+			return self.imageCache.getCropped(), 1
+		
+		# mime data is attached, so never use the cached surface
+		image = self.imageCache.getCropped(copy=True)
+		if codec == "downsample":
+			factor 			= max(1, float(options["downsample"]))
+			width 			= image.get_width()
+			height 			= image.get_height()
+			smallWidth 		= max(1, int(math.ceil(width/factor)))
+			smallHeight 	= max(1, int(math.ceil(height/factor)))
+			small 	= cairo.ImageSurface(image.get_format(), smallWidth, smallHeight)
+			ctx 	= cairo.Context(small)
+			ctx.scale(float(smallWidth)/width, float(smallHeight)/height)
+			ctx.set_source_surface(image, 0, 0)
+			ctx.get_source().set_filter(cairo.FILTER_GOOD)
+			ctx.paint()
+			return small, float(width)/smallWidth
+		
+		elif codec == "jpeg":
+			image.set_mime_data(cairo.MIME_TYPE_JPEG, encodeJpeg(image, int(options["quality"])))
+		
+		elif codec == "link":
+			path = "%s_image.png" % os.path.splitext(self.svgFile)[0]
+			image.write_to_png(path)
+			image.set_mime_data(cairo.MIME_TYPE_URI, os.path.basename(path))
+			self.written.append(path)
+		
+		else:
+			raise ValueError("unknown svg image codec: %s" % codec)
+		return image, 1
+	
+	def viewMatrix(self, width, height):
+		''' the transformation of applyView as matrix '''
+		sx, sy = self.scroll
+		return cairo.Matrix(self.zoom, 0, 0, self.zoom, width/2 + self.zoom*sx, height/2 + self.zoom*sy)
+	
+	def deviceToUser(self, x, y):
+		''' device to user space of the view, without a cairo context '''
+		width, height 	= self.canvasSize()
+		matrix 			= self.viewMatrix(width, height)
+		matrix.invert()
+		return matrix.transform_point(x, y)
+	
+	def applyView(self, width, height):
+		#self.cr.scale(width*ratio,height)
+		#self.cr.scale(0.001, 0.001) 			# make it 1000*ratiox1000
+		self.cr.translate (width/2,height/2)	# set center
+		self.cr.scale(self.zoom, self.zoom)		# zoom
+		
+		sx,sy = self.scroll
+
+		self.cr.translate (sx,sy)				# move scroll
+	
+	def openFile(self, tiled=True):
+		'''	paints the image. On screen only the visible tiles of the fitting
+			pyramid level are painted, exports get the full image at once.
+			If the image is cropped only the pixels inside the crop are used
+		'''
+		if self.infos["file"] != False:
+			
+
+			
+			# rectangle for the image
+			posx, posy = self.imagePos
+			posx = posx - self.infos["imageWidth"]/2
+			posy = posy - self.infos["imageHeight"]/2
+			
+			# part of the image inside the crop, in pixels
+			crop = self.cropPixels()
+			self.imageCache.setCrop(crop)
+			if crop == False:
+				crop = (0, 0, self.infos["imageWidth"], self.infos["imageHeight"])
+			cropX, cropY, cropWidth, cropHeight = crop
+			
+			self.cr.save()
+			box = self.activeCrop()
+			if box != False:
+				self.cr.rectangle(box[0], box[1], box[2]-box[0], box[3]-box[1])
+				self.cr.clip()
+			
+			# rotate canvas?
+			self.cr.rotate(self.infos["rotate"])
+			
+			if cropWidth > 0 and cropHeight > 0:
+				self.cr.translate(posx+cropX, posy+cropY)
+				if tiled:
+					# get the image, the surfaces are cached
+					# when zoomed out a smaller level of the pyramid is enough
+					width, height 	= self.canvasSize()
+					level 			= self.imageCache.levelFor(self.zoom, width, height)
+					levelWidth, levelHeight = self.imageCache.levelSize(level)
+					
+					self.cr.scale(float(cropWidth)/levelWidth, float(cropHeight)/levelHeight)
+					
+					# paint the image, only the visible tiles
+					self.imageCache.paintLevel(self.cr, level)
+				else:
+					image, factor = self.exportImage()
+					self.cr.scale(factor, factor)
+					self.cr.set_source_surface(image, 0, 0)
+					self.cr.paint()
+			
+			# rotate back!
+			self.cr.restore()
+	
+	def activeCrop(self):
+		'''	the crop box (left, top, right, bottom) in user space.
+			While the crop is dragged, it is only a preview
+		'''
+		if self.document.crop == False or self.cropDragging:
+			return False
+		(x1, y1), (x2, y2) = self.document.crop
+		return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+	
+	def cropPixels(self):
+		''' the crop as (x, y, width, height) in pixels of the image '''
+		box = self.activeCrop()
+		if box == False:
+			return False
+		left, top, right, bottom = box
+		
+		xs 		= []
+		ys 		= []
+		for x, y in ((left, top), (right, top), (left, bottom), (right, bottom)):
+			x, y = self.userToPixel(x, y)
+			xs.append(x)
+			ys.append(y)
+		
+		x1 = max(0, int(math.floor(min(xs))))
+		y1 = max(0, int(math.floor(min(ys))))
+		x2 = min(self.infos["imageWidth"], int(math.ceil(max(xs))))
+		y2 = min(self.infos["imageHeight"], int(math.ceil(max(ys))))
+		return (x1, y1, max(0, x2-x1), max(0, y2-y1))
+	
+	def userToPixel(self, x, y):
+		''' user space to pixels of the image, undoes the rotation of the canvas '''
+		posx 	= self.imagePos[0] - self.infos["imageWidth"]/2
+		posy 	= self.imagePos[1] - self.infos["imageHeight"]/2
+		angle 	= self.infos["rotate"]
+		return ( x*math.cos(angle) + y*math.sin(angle) - posx,
+				-x*math.sin(angle) + y*math.cos(angle) - posy)
+	
+	def pixelToUser(self, x, y):
+		''' pixels of the image to user space '''
+		x 		= x + self.imagePos[0] - self.infos["imageWidth"]/2
+		y 		= y + self.imagePos[1] - self.infos["imageHeight"]/2
+		angle 	= self.infos["rotate"]
+		return (x*math.cos(angle) - y*math.sin(angle),
+				x*math.sin(angle) + y*math.cos(angle))
+	
+	def analysisRegion(self):
+		'''	the pixels used for analysis, (height, width) of the cropped image.
+			16 bit images give their raw data
+		'''
+		pixels = self.imageCache.pixels
+		crop = self.cropPixels()
+		if crop == False:
+			crop = (0, 0, pixels.width, pixels.height)
+		x, y, width, height = crop
+		if pixels.raw is not False and pixels.rawShown:
+			region = pixels.readRaw(x, y, width, height)[..., 0]
+		else:
+			region = pixels.rgb[y:y+height, x:x+width, 1]
+		return crop, region
+	
+	def detectLanes(self, pitch=False, dark=None):
+		'''	puts a lane marker above every lane of the image.
+			The lanes are the peaks of the column projection, dark tells
+			if they are darker than the gel (guessed if None)
+		'''
+		if self.infos["file"] == False:
+			return []
+		(x, y, width, height), region = self.analysisRegion()
+		if width < 3 or height < 1:
+			return []
+		
+		# a few hundred rows are enough for the projection
+		sample 	= region[::max(1, height / 512)]
+		profile = sample.sum(axis=0, dtype=numpy.float64)
+		if dark is None:
+			dark = darkBands(profile)
+		lanes 	= findLanes(profile, dark, pitch)
+		
+		markers = []
+		for lane in lanes:
+			markerX, markerY = self.pixelToUser(x + lane + 0.5, y)
+			markers.append((markerX, markerY - float(self.ladderFontSize)/self.zoom))
+		self.document.setLaneMarkers(markers)
+		return self.document.laneMarkers
+	
+	def detectBands(self, index=-1, dark=None):
+		'''	finds the bands of a ladder on the gel and matches them in order
+			to the fragments, the largest at the top. The lane is the one
+			with clicked bands, or the lane next to the ladder labels
+		'''
+		if self.infos["file"] == False or len(self.document.ladders) == 0:
+			return []
+		ladder = self.document.ladders[index]
+		(x, y, width, height), region = self.analysisRegion()
+		if width < 3 or height < 3:
+			return []
+		sample 	= region[::max(1, height / 512)]
+		columns = sample.sum(axis=0, dtype=numpy.float64)
+		if dark is None:
+			dark = darkBands(columns)
+		lanes 	= findLanes(columns, dark)
+		if len(lanes) == 0:
+			return []
+		
+		# lane of the ladder, in pixels of the region
+		if len(ladder.bands) > 0:
+			laneX = self.userToPixel(*ladder.bands[0])[0] - x
+		else:
+			laneX = self.userToPixel(*ladder.start)[0] - x
+		lane = lanes[numpy.argmin(numpy.abs(lanes - laneX))]
+		if len(lanes) > 1:
+			halfWidth = max(1, int(numpy.diff(lanes).min() * 0.3))
+		else:
+			halfWidth = max(1, width / 20)
+		
+		# profile along the middle of the lane
+		left 	= max(0, int(lane) - halfWidth)
+		profile = region[:, left:int(lane) + halfWidth + 1].sum(axis=1, dtype=numpy.float64)
+		bands 	= findBands(profile, len(self.ladders[ladder.name]), dark)
+		
+		self.document.setBands(index, [self.pixelToUser(x + lane + 0.5, y + band + 0.5) for band in bands])
+		return self.document.ladders[index].bands
+	
+	def calibration(self, index=0, kind="piecewise"):
+		''' size model of a drawn ladder, from its bands '''
+		ladder = self.document.ladders[index]
+		return LadderCalibration.fromLadder(self.ladders[ladder.name], ladder.start, ladder.stop, ladder.bands, kind)
+	
+	def sizeTable(self, index=0, kind="piecewise", dark=None):
+		'''	size of every band in every lane, by the calibration of a ladder.
+			The lanes are the lane markers, or they are detected.
+			Returns rows of (lane, band, position, size, unit), the position
+			is in user space like the ladder, the size in self.infos["unit"]
+		'''
+		if self.infos["file"] == False or len(self.document.ladders) == 0:
+			return []
+		calibration = self.calibration(index, kind)
+		(x, y, width, height), region = self.analysisRegion()
+		if width < 3 or height < 3:
+			return []
+		sample 	= region[::max(1, height / 512)]
+		columns = sample.sum(axis=0, dtype=numpy.float64)
+		if dark is None:
+			dark = darkBands(columns)
+		
+		if len(self.document.laneMarkers) > 0:
+			lanes = numpy.array([self.userToPixel(*marker)[0] - x for marker in sorted(self.document.laneMarkers)])
+		else:
+			lanes = findLanes(columns, dark)
+		if len(lanes) == 0:
+			return []
+		if len(lanes) > 1:
+			halfWidth = max(1, int(numpy.diff(lanes).min() * 0.3))
+		else:
+			halfWidth = max(1, width / 20)
+		
+		# bands of all lanes, then the sizes in one go
+		laneIndex 	= []
+		bandIndex 	= []
+		positions 	= []
+		for i, lane in enumerate(lanes):
+			# lane markers can lie outside of the crop
+			left 	= min(max(0, int(lane) - halfWidth), width)
+			right 	= min(max(0, int(lane) + halfWidth + 1), width)
+			if right - left < 1:
+				continue
+			profile = region[:, left:right].sum(axis=1, dtype=numpy.float64)
+			for j, band in enumerate(findBands(profile, False, dark)):
+				laneIndex.append(i + 1)
+				bandIndex.append(j + 1)
+				positions.append(self.pixelToUser(x + lane + 0.5, y + band + 0.5))
+		if len(positions) == 0:
+			return []
+		
+		positions 	= numpy.array(positions)
+		sizes 		= calibration.sizes(positions[:, 1])
+		unit 		= self.infos["unit"]
+		if unit[:1] == "k":
+			sizes = sizes / 1000.0
+		return zip(laneIndex, bandIndex, positions[:, 1].tolist(), sizes.tolist(), [unit] * len(sizes))
+	
+	def writeSizeTable(self, filepath, index=0, kind="piecewise"):
+		''' the size table as csv file '''
+		rows = self.sizeTable(index, kind)
+		with open(filepath, "wb") as f:
+			writer = csv.writer(f)
+			writer.writerow(["lane", "band", "position", "size", "unit"])
+			for lane, band, position, size, unit in rows:
+				writer.writerow([lane, band, "%.2f" % position, "%.4g" % size, unit])
+		return rows
+	
+	def deskew(self):
+		'''	rotates the image so the lanes are vertical. The angle is
+			estimated on a small copy of the image, then the rotation
+			is baked into the pixels
+		'''
+		if self.infos["file"] == False:
+			return False
+		pixels 	= self.imageCache.pixels
+		step 	= max(1, max(pixels.width, pixels.height) / 400)
+		if pixels.raw is not False and pixels.rawShown:
+			sample = pixels.raw[::step, ::step, 0]
+		else:
+			sample = pixels.rgb[::step, ::step, 1]
+		self.infos["rotate"] = estimateSkew(sample)
+		self.bakeRotation()
+		return True
+	
+	def bakeRotation(self):
+		'''	puts the rotation of the canvas into the pixels, so the image is
+			painted without rotating and resampling it on every redraw
+		'''
+		angle = self.infos["rotate"]
+		if self.infos["file"] == False or angle == 0:
+			return
+		
+		# the centre of the image moves with the rotation around the origin
+		x, y = self.imagePos
+		self.imagePos = (x*math.cos(angle) - y*math.sin(angle), x*math.sin(angle) + y*math.cos(angle))
+		self.infos["rotate"] 		= 0
+		self.infos["bakedRotate"] 	= self.infos.get("bakedRotate", 0) + angle
+		self.rotatePixels(angle)
+	
+	def rotatePixels(self, angle):
+		'''	rotates the pixels of the image, imagePos is not changed.
+			Used again after loading, the file is never rotated
+		'''
+		if self.imageCache.pixels is False or angle == 0:
+			return
+		pixels = self.imageCache.pixels.rotated(angle)
+		self.infos["pixels"] = pixels
+		self.imageCache.invalidate(pixels, self.imageCache.scale)
+	
+	def drawOverlay(self):
+		''' everything on top of the image, cheap to redraw '''
+		self.bounds 		= {}
+		self.parts 			= []
+		self.partsMatrix 	= self.cr.get_matrix()
+		self.overlayDraws 	= self.overlayDraws + 1
+		
+		# crop:
+		self.drawCrop()
+
+	
+		# ladder
+		self.drawLadder()
+
+	
+		# draw labels?
+		if len(self.document.laneMarkers) > 0:
+			self.drawLabels()
+		
+		# draw export?
+		self.selectExportRange()
+	
+	def markBounds(self, key, x1, y1, x2, y2):
+		''' extends the device space bounds of an annotation by a user space box '''
+		corners = [self.cr.user_to_device(x, y) for x, y in ((x1,y1), (x2,y1), (x2,y2), (x1,y2))]
+		self.addPart(key, ("quad", corners))
+	
+	def markStroke(self, key, points, width):
+		''' same for a line through the user space points '''
+		corners = [self.cr.user_to_device(x, y) for x, y in points]
+		radius 	= max(math.hypot(*self.cr.user_to_device_distance(width, 0)) / 2, HIT_TOLERANCE)
+		self.addPart(key, ("line", corners, radius))
+	
+	def addPart(self, key, shape):
+		xs 		= [x for x, y in shape[1]]
+		ys 		= [y for x, y in shape[1]]
+		pad 	= shape[2] if shape[0] == "line" else 0
+		part 	= (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+		box 	= self.bounds.get(key)
+		if box is None:
+			box = list(part)
+		else:
+			box = [min(box[0], part[0]), min(box[1], part[1]), max(box[2], part[2]), max(box[3], part[3])]
+		self.bounds[key] = box
+		self.parts.append((key, part, shape))
+	
+	def hitTest(self, x, y):
+		'''	keys of the annotations at the user space point, the topmost first.
+			The boxes of the last drawn overlay are put into a grid once per
+			draw, a test only looks at the boxes of one cell and then checks
+			their exact shape (rotated texts, lines)
+		'''
+		if self.partsMatrix is False:
+			return []
+		if self.grid is False or self.gridKey != (self.overlayDraws, self.document.version):
+			self.grid 		= SpatialGrid.fromBoxes([(index, part[1]) for index, part in enumerate(self.parts)])
+			self.gridKey 	= (self.overlayDraws, self.document.version)
+		
+		# the parts are in device space of the view they were drawn in
+		dx, dy 	= self.partsMatrix.transform_point(x, y)
+		hits 	= []
+		for index in self.grid.query(dx, dy):
+			key, box, shape = self.parts[index]
+			if key not in hits and shapeHit(shape, dx, dy):
+				hits.append(key)
+		return hits
+	
+	def imageHit(self, x, y):
+		''' is the user space point on the (cropped) image? '''
+		if self.infos["file"] == False:
+			return False
+		box = self.activeCrop()
+		if box != False and not (box[0] <= x <= box[2] and box[1] <= y <= box[3]):
+			return False
+		px, py = self.userToPixel(x, y)
+		return 0 <= px <= self.infos["imageWidth"] and 0 <= py <= self.infos["imageHeight"]
+	
+	def measureOverlay(self):
+		'''	draws the overlay on a 1x1 surface with the current transformation,
+			just to record the bounds of the annotations
+		'''
+		cr 		= self.cr
+		self.cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+		self.cr.set_matrix(cr.get_matrix())
+		self.drawOverlay()
+		self.cr = cr
+		return dict(self.bounds)
+	
+	# Ladders
+	def ladderLayout(self, name, start, stop, fontSize):
+		'''	labels of a ladder as (text, position, xbearing, ybearing, width, height),
+			largest fragment first. The font has to be set on self.cr.
+			They are only computed again if the ladder, the unit, the font,
+			the zoom (in fontSize) or the endpoints changed
+		'''
+		unit 		= self.infos["unit"]
+		fragments 	= self.ladders[name]
+		key 		= ("ladder", name, tuple(fragments), unit, self.infos['fontfamily'],
+						self.infos['fontstyle'], self.infos['fontweight'], fontSize, start, stop)
+		layout 		= self.layoutCache.get(key)
+		if layout is not False:
+			return layout
+		
+		# the labels are spread from start to stop, log-linear to the size.
+		# A ladder that is just started has no length, all labels are at start
+		if start[1] != stop[1]:
+			labels = LadderCalibration.fromLadder(fragments, start, stop, [])
+		else:
+			labels = False
+		layout = []
+		for l in sorted(fragments, reverse=True):
+			# if kilo add a point:
+			if unit[:1] == "k":
+				num = str(round(float(l)/float(1000),2))
+				parts = num.split(".")
+				number = "%s.%s" % (parts[0],parts[1])
+			else:
+				number = str(l)
+			text = "%s %s" % (number, unit)
+			
+			if labels is not False:
+				position = labels.position(l)
+			else:
+				position = start[1]
+			
+			xbearing, ybearing, TextWidth, TextHeight, xadvance, yadvance = self.cr.text_extents(text)
+			layout.append((text, position, xbearing, ybearing, TextWidth, TextHeight))
+		
+		self.layoutCache.put(key, layout)
+		return layout
+	
+	def drawLadder(self):
+		# settings
+		fontSize 	= self.px2Dist(self.ladderFontSize) #px
+		self.cr.select_font_face(self.infos['fontfamily'], self.infos['fontstyle'], self.infos['fontweight'])
+		self.cr.set_font_size(fontSize)
+		self.cr.set_source_rgb (0,0,0)
+				
+		# main loop
+		for index, ladder in enumerate(self.document.ladders):
+			key 		= ("ladder", index)
+			name 		= ladder.name
+			start 		= ladder.start
+			stop  		= ladder.stop
+			
+			# where are the fragments on the gel?
+			positions 	= ladder.bands
+
+			# get middle x range for lines:
+			if len(positions) > 0:
+				averageX = sum(v[0] for v in positions)/len(positions)
+				#averageX = sum(xpositions)/len(xpositions)
+			else:
+				averageX = 0
+			
+			i = 0
+			for text, position, xbearing, ybearing, TextWidth, TextHeight in self.ladderLayout(name, start, stop, fontSize):
+				
+				# only draw if we did not yet specify the bands
+				# or if there is one by click!
+				if len(positions) == 0 or i < len(positions):
+					
+					# check if ladder is to be drawn right or left:
+					if averageX >= start[0]:
+						# it is left of the image:
+						ladderSite=True
+					
+						self.cr.move_to(start[0]-TextWidth,position); 
+					else:
+						self.cr.move_to(start[0],position); 
+						ladderSite=False
+					
+					textX, textY = self.cr.get_current_point()
+					self.markBounds(key, textX+xbearing, textY+ybearing, textX+xbearing+TextWidth, textY+ybearing+TextHeight)
+					self.cr.show_text(text)
+					#self.cr.show_glyphs(text)
+					
+					if i <= len(positions) and len(positions) > 0:
+						# also draw the line for this fragment
+						self.cr.set_source_rgb(0,0,0) # Solid color
+						self.cr.set_line_width(self.px2Dist(1)) # or 0.1
+						if ladderSite:
+							side = 1
+						else:
+							side = -1
+						points = [(start[0]+side*self.px2Dist(3), position-TextHeight/4),
+								  (start[0]+side*self.px2Dist(7), position-TextHeight/4),
+								  (averageX-side*self.px2Dist(8), positions[i][1]),
+								  (averageX, positions[i][1])]
+						self.cr.move_to(*points[0])
+						for point in points[1:]:
+							self.cr.line_to(*point)
+						self.markStroke(key, points, self.cr.get_line_width())
+						self.cr.stroke()
+					
+				
+				i = i+1
+
+
+		return True
+	
+	def drawCrop(self):
+
+		# while the crop is dragged we draw 4 white boxes as preview,
+		# afterwards the image itself is cropped
+		if self.document.crop != False and self.cropDragging:
+			
+			posX1 = self.document.crop[0][0]
+			posY1 = self.document.crop[0][1]
+			
+			posX2 = self.document.crop[1][0]
+			posY2 = self.document.crop[1][1]
+			left, top, right, bottom = self.canvasExtents()
+			
+			
+			
+			self.cr.set_source_rgba(1,1,1,1) # Solid color
+			self.cr.set_line_width(0) # or 0.1
+			
+			# left white box
+			self.cr.rectangle(left, top, posX1-left, bottom-top)
+			self.cr.fill()
+			
+			# right box
+			self.cr.rectangle(posX2, top, right-posX2, bottom-top)
+			self.cr.fill()
+		
+			# upper box:
+			self.cr.rectangle(left, top, right-left, posY1-top)
+			self.cr.fill()
+			
+			#lower
+			self.cr.rectangle(left, posY2, right-left, bottom-posY2)
+			self.cr.fill()
+			
+			self.markBounds("crop", left, top, right, bottom)
+			
+				
+		
+		
+		return True
+	
+	def drawLabels(self):
+		sumx =0 
+		sumy =0
+		laneMarkers = self.document.laneMarkers
+		for xy in laneMarkers:
+			sumx = sumx+xy[0]
+			sumy = sumy+xy[1]
+		
+		averageX = float(sumx)/len(laneMarkers)
+		averageY = float(sumy)/len(laneMarkers)
+		
+		markertype = self.infos['marks']
+		if markertype == "ABC" or markertype == "abc":
+			markerLst = labelList[markertype]
+		
+		elif markertype == "custom":
+			markerLst = self.infos['custommarks']
+		else:
+			# normal numbers
+			markerLst = range(1,len(laneMarkers)+1)
+		
+		# the font is the same for all labels
+		fontSize = self.px2Dist(self.ladderFontSize) #px
+		self.cr.select_font_face(self.infos['fontfamily'], self.infos['fontstyle'], self.infos['fontweight'])
+		self.cr.set_font_size(fontSize)
+		self.cr.set_source_rgb (0,0,0)
+		
+		# glyphs of all labels that are not rotated, drawn in one run
+		run = []
+		
+		i = 0
+		for pos in laneMarkers:
+
+			if i >= len(markerLst):
+				newI = i-(len(markerLst))
+				A = markerLst[newI]
+				text = "%s.%d" % (A, newI+1)
+			else: 
+				text = markerLst[i]
+			
+			glyphs, (xbearing, ybearing, TextWidth, TextHeight, xadvance, yadvance) = self.glyphRun(text, fontSize)
+			
+			# custom labels will no be centered, but can be rotated to fit
+			if markertype == "custom":
+				self.cr.save()
+				self.cr.translate(pos[0], averageY)
+				self.cr.rotate(math.radians(self.infos['rotateLabel']))
+				self.markBounds(("label", i), xbearing, ybearing, xbearing+TextWidth, ybearing+TextHeight)
+				if glyphs is False:
+					self.cr.move_to(0, 0)
+					self.cr.show_text(text)
+				else:
+					self.cr.show_glyphs(glyphs)
+				self.cr.restore()		
+			else:
+				textX = pos[0]-TextWidth/2
+				self.markBounds(("label", i), textX+xbearing, averageY+ybearing, textX+xbearing+TextWidth, averageY+ybearing+TextHeight)
+				if glyphs is False:
+					self.cr.move_to(textX, averageY)
+					self.cr.show_text(text)
+				else:
+					run.extend((index, x + textX, y + averageY) for index, x, y in glyphs)
+			
+			
+			i = i + 1
+		
+		if len(run) > 0:
+			self.cr.show_glyphs(run)
+	
+	def glyphRun(self, text, fontSize):
+		'''	glyphs of a label at the origin and its text extents, only made
+			once per text and font. The font has to be set on self.cr.
+			Without text_to_glyphs (old pycairo) the glyphs are False
+		'''
+		if isinstance(text, str):
+			text = text.decode("utf-8", "replace")
+		else:
+			text = unicode(text)
+		key = ("glyphs", text, self.infos['fontfamily'], self.infos['fontstyle'], self.infos['fontweight'], fontSize)
+		entry = self.layoutCache.get(key)
+		if entry is not False:
+			return entry
+		
+		extents 	= self.cr.text_extents(text)
+		scaledFont 	= self.cr.get_scaled_font()
+		if hasattr(scaledFont, "text_to_glyphs"):
+			glyphs = [(glyph[0], glyph[1], glyph[2]) for glyph in scaledFont.text_to_glyphs(0, 0, text, False)]
+		else:
+			glyphs = False
+		entry = (glyphs, extents)
+		self.layoutCache.put(key, entry)
+		return entry
+	
+	def selectExportRange(self):
+		''' drag and drop to select range for export'''
+		if self.drawExport and self.document.export != False:
+			x = self.document.export[0][0]
+			y = self.document.export[0][1]
+			width = self.document.export[1][0]-x
+			height= self.document.export[1][1]-y
+			
+			self.cr.set_source_rgba(0,0,0,0.8) # Solid color
+			self.cr.set_line_width(1) # or 0.1
+			self.cr.rectangle(x,y,width, height)
+			x1, y1, x2, y2 = self.cr.stroke_extents()
+			self.markBounds("export", x1, y1, x2, y2)
+			self.cr.stroke()
+		return True
 
 
 
@@ -133,12 +2691,13 @@ class BufferedWindow(wx.Window):
 
 
 
-class DrawingArea(BufferedWindow):
+class DrawingArea(BufferedWindow, GelPainter):
 	'''	Class to provide the drawing canvas
 		it handles vereythink from drag and drop to exporting the svg file
 	'''
 	def __init__ (self ,parent, title, infos, ladders ):
 		super(DrawingArea , self).__init__ (parent=parent,id=wx.ID_ANY)
+		GelPainter.__init__(self)
 		self.infos 		= infos
 		self.ladders 	= ladders
 		
@@ -149,24 +2708,26 @@ class DrawingArea(BufferedWindow):
 		self.dragging 	= [False,False]
 		
 		
-		self.imagePos 	= (0,0)
-		self.imagePath 	= False
-		self.imageCrop	= False		# if image should be croped
-		self.imageExport= [False,False]
-		self.drawExport = False
 		self.ImageClick = False
 				
-		self.drawnLadders	= []
-		self.tempLadder 	= False
 		self.ladderFontSize = int(self.infos['fontsize'])  #px
 		
-		self.laneMarkers 	= []
+		# ImageLoader of an image that is still read, a preview is shown
+		self.loader 	= False
 		
-		self.scroll		= (0,0)
-		self.zoom		= 1
+		# the mouse is over an annotation
+		self.hover 		= False
 
 		
-		self.objPath    = {}
+		# the image is rendered into its own layer, annotations are
+		# painted on top of it. The layer is kept until the view changes
+		self.background 		= False
+		self.backgroundKey 		= False
+		self.backgroundRenders 	= 0
+		self.backgroundReuses 	= 0
+		
+		# mouse events only ask for a redraw, it is done once per frame
+		self.redraw = RedrawScheduler(self.updateGUI)
 		
 		#self.SetDoubleBuffered(True)
 		#self.Bind(wx.EVT_PAINT, self.OnPaint)
@@ -188,72 +2749,137 @@ class DrawingArea(BufferedWindow):
 		# update some var
 		self.ladderFontSize = int(self.infos['fontsize'])  #px
 		
-
+		# we draw now, a scheduled redraw is not needed anymore
+		self.redraw.cancel()
 
 		self.UpdateDrawing()
-
-
 	
+	def requestRedraw(self):
+		''' redraw with the next frame, used for mouse motion and wheel '''
+		self.redraw.request()
+	
+	def updateDamaged(self, before):
+		'''	redraws only the annotations whose bounds changed
+			since the bounds in before were recorded
+		'''
+		if self.redraw.pending:
+			# the view changed, so everything has to be drawn anyway
+			self.updateGUI()
+			return
+		
+		after 	= self.measureOverlay()
+		rects 	= []
+		for key in set(before.keys()) | set(after.keys()):
+			if before.get(key) != after.get(key):
+				for box in (before.get(key), after.get(key)):
+					if box is not None:
+						rects.append(self.boundsToRect(box))
+		
+		if len(rects) > 0:
+			self.UpdateDrawing(rects)
+	
+	def boundsToRect(self, box):
+		# pad a bit, for antialiasing and line width
+		x1 = int(math.floor(box[0])) - 2
+		y1 = int(math.floor(box[1])) - 2
+		x2 = int(math.ceil(box[2])) + 2
+		y2 = int(math.ceil(box[3])) + 2
+		return (x1, y1, x2-x1, y2-y1)
 	
 	def returnInfo(self):
 		return self.infos
 	
-	def px2Dist(self, px):
-		return self.cr.device_to_user_distance(0,px)[1]
-
-	def Draw(self, dc, export = False, cr = False):
-		dc.Clear() 
-		if export == False:
-			
-			self.cr = wx.lib.wxcairo.ContextFromDC(dc)
-
-
-				
-			width, height 	= self.GetVirtualSize()	# set hight and width. Its 100, 100 
-		else:
-			width, height 	= self.GetVirtualSize()	# set hight and width. Its 100, 100 
-			self.cr = cr
+	def invalidateImage(self):
+		''' call if there is a new image (open, baked rotation) or the full image replaces the preview '''
+		pixels 	= self.infos.get('pixels', False)
+		scale 	= (1, 1)
+		if pixels is not False and self.infos.get("imageWidth"):
+			scale = (float(pixels.width) / self.infos["imageWidth"], float(pixels.height) / self.infos["imageHeight"])
+		self.imageCache.invalidate(pixels, scale)
+	
+	def waitForImage(self):
+		''' the full image is needed (export, analysis), waits until the loader has read it '''
+		if self.loader is False:
+			return
+		wx.BeginBusyCursor()
+		try:
+			self.loader.wait()
+		finally:
+			wx.EndBusyCursor()
+	
+	def imageChanged(self):
+		''' call if the pixels were changed in place (invert, grayscale, ...) '''
+		self.imageCache.changed()
+	
+	def imageCacheStats(self):
+		return self.imageCache.stats()
+	
+	def layoutCacheStats(self):
+		return self.layoutCache.stats()
+	
+	def canvasSize(self):
+		return self.GetVirtualSize()
+	
+	def notify(self, text):
+		self.GetTopLevelParent().SetStatusText(text)
+	
+	def Draw(self, dc, clip = False):
+		if clip == False:
+			dc.Clear() 
+		
+		self.cr = wx.lib.wxcairo.ContextFromDC(dc)
+		width, height 	= self.GetVirtualSize()	# set hight and width. Its 100, 100 
 
 		
 		if width != 0 and height != 0 and height > 100 and width > 100:
-			#self.cr.scale(width*ratio,height)
-			#self.cr.scale(0.001, 0.001) 			# make it 1000*ratiox1000
-			self.cr.translate (width/2,height/2)	# set center
-			self.cr.scale(self.zoom, self.zoom)		# zoom
 			
-			sx,sy = self.scroll
-
-			self.cr.translate (sx,sy)				# move scroll
+			# only draw the damaged parts
+			if clip != False:
+				for x, y, w, h in clip:
+					self.cr.rectangle(x, y, w, h)
+				self.cr.clip()
 			
-			#self.DoDrawing() 
-
-
-			# first the image, as background
-			self.openFile()
-
-		
-			# crop:
-			self.drawCrop()
-
-		
-			# ladder
-			self.drawLadder()
-
-		
-			# draw labels?
-			if len(self.laneMarkers) > 0:
-				self.drawLabels()
+			# first the image, as background layer
+			self.cr.set_source_surface(self.renderBackground(width, height), 0, 0)
+			self.cr.paint()
+			self.applyView(width, height)
 			
-			# draw export?
-			self.selectExportRange()
+			# overlay:
+			self.drawOverlay()
 		
 		return True
-		
+	
+	def renderBackground(self, width, height):
+		'''	returns the background layer: the rotated image at the current
+			zoom and scroll. It is only rendered again if one of these changed
+		'''
+		key = (width, height, self.zoom, self.scroll, self.imagePos, self.activeCrop(),
+				self.infos["file"], self.infos["rotate"], self.imageCache.version)
+		if self.background is not False and key == self.backgroundKey:
+			self.backgroundReuses = self.backgroundReuses + 1
+			return self.background
+		
+		surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+		ctx 	= cairo.Context(surface)
+		ctx.set_source_rgb(1,1,1)
+		ctx.paint()
+		
+		# draw the image with the normal drawing code
+		cr 		= self.cr
+		self.cr = ctx
+		self.applyView(width, height)
+		self.openFile()
+		self.cr = cr
+		
+		self.background 		= surface
+		self.backgroundKey 		= key
+		self.backgroundRenders 	= self.backgroundRenders + 1
+		return surface
 	
 	def OnLeftDown(self,e):
 		
 		x, y = self.ScreenToClient(wx.GetMousePosition())
-		x2, y2 = self.cr.device_to_user(x,y)
+		x2, y2 = self.deviceToUser(x,y)
 		self.dragging[0] = (x2,y2)
 		self.dragging[1] = (x2,y2)
 		
@@ -262,16 +2888,7 @@ class DrawingArea(BufferedWindow):
 		
 		
 		# check if the click is on the image:
-		if self.imagePath != False:
-			self.ImageClick = False
-			self.cr.append_path(self.imagePath) 
-			inFill = self.cr.in_fill(x2,y2) 
-			inStroke = self.cr.in_stroke(x2,y2)
-
-			# check if mouse hit a path:
-			if inFill == True or inStroke == True:
-				self.ImageClick  = True
-		#self.cr.fill()
+		self.ImageClick = self.imageHit(x2, y2)
 		
 		if self.infos["currentAction"] == "SelectExport":
 			self.drawExport = True
@@ -281,13 +2898,14 @@ class DrawingArea(BufferedWindow):
 	
 	def OnLeftUp(self,event):
 		x, y 			= self.ScreenToClient(wx.GetMousePosition())
-		x2, y2 			= self.cr.device_to_user(x,y)
+		x2, y2 			= self.deviceToUser(x,y)
 		ctrl 			= event.ControlDown()
 		self.tempLadder = False
+		before 			= dict(self.bounds)
 		
 		# if draw lader lines:
 		if self.infos["currentAction"] == "drawLadderLines" and ctrl == False:
-			self.drawnLadders[len(self.drawnLadders)-1][3].append((x2,y2))
+			self.document.addBand(-1, (x2,y2))
 			
 
 		
@@ -303,9 +2921,19 @@ class DrawingArea(BufferedWindow):
 			self.infos["currentAction"] = False
 	
 		if self.infos["currentAction"] == 'LabelLanes' and ctrl == False:
-			self.laneMarkers.append((x2,y2))
+			self.document.addLaneMarker((x2,y2))
 		
-		self.updateGUI()
+		# the click or drag is one undo step
+		self.checkpoint()
+		
+		if self.cropDragging:
+			# now crop the image itself
+			self.cropDragging = False
+			self.updateGUI()
+			return True
+		
+		# only redraw what changed
+		self.updateDamaged(before)
 		return True  
 		
 	def OnScroll(self, event):
@@ -321,7 +2949,7 @@ class DrawingArea(BufferedWindow):
 		if self.zoom < 0.1:
 			self.zoom = 0.1
 		
-		self.updateGUI()
+		self.requestRedraw()
 		return True   
 	
 	def OnMotion(self, event): 
@@ -332,7 +2960,7 @@ class DrawingArea(BufferedWindow):
 			# previous x2, y2:
 			x2Prev, y2Prev 		= self.dragging[1]
 			x, y 				= self.ScreenToClient(wx.GetMousePosition())
-			x2, y2 				= self.cr.device_to_user(x,y)
+			x2, y2 				= self.deviceToUser(x,y)
 			dx					= x2-x2Prev
 			dy					= y2-y2Prev
 			self.dragging[1] 	= (x2,y2)
@@ -349,340 +2977,83 @@ class DrawingArea(BufferedWindow):
 				
 			elif self.infos["currentAction"]=="addLadder":
 				
-				# remove the last item, as this is the temp ladder
-				if self.tempLadder != False:
-					self.drawnLadders.pop()
-				
-				# make a list for ladder handling
-				selLadder = self.infos["ladder"]
-				self.tempLadder = [selLadder,self.dragging[0],self.dragging[1],[]]
-				self.drawnLadders.append(self.tempLadder)
-				updateNow = True
-
-			
-			elif self.ImageClick == True and self.infos["currentAction"] == "MoveImage":	
-				# current position:
-				cx, cy = self.imagePos
-				
-				newX = cx + x2-x2Prev
-				newY = cy + y2-y2Prev
-				
-				self.imagePos = (newX, newY)
-				updateNow = True
-			
-			elif self.infos["currentAction"] == "RotateImage":	
-				# current position:
-				self.infos["rotate"] = 0.01 * (self.dragging[0][0] - self.dragging[1][0])
-				updateNow = True
-				
-			
-			elif self.infos["currentAction"] == "CropImage":
-				self.imageCrop=[False,False]
-				self.imageCrop[0] = self.dragging[0]
-				self.imageCrop[1] = (x2,y2)
-				updateNow = True
-				
-			elif self.infos["currentAction"]== "SelectExport":
-				# select area to export:
-				self.imageExport=[False,False]
-				self.imageExport[0] = self.dragging[0]
-				self.imageExport[1] = (x2,y2)
-				updateNow = True
-				
-			#else:
-			#	print "nothing to do"
-			
-
-			if updateNow:
-				self.updateGUI()
-		
-
-
-	
-	def hitTest(self):
-		
-		hit = None
-		x, y = self.ScreenToClient(wx.GetMousePosition())	
-		
-		# get the mouse positions
-		x2, y2 = self.cr.device_to_user(x,y)
-		
-		for item in self.objPath:
-			path = self.objPath[item]
-			self.cr.append_path(path)
-			inFill = self.cr.in_fill(x2,y2) 
-			inStroke = self.cr.in_stroke(x2,y2)
-			
-			# check if mouse hit a path:
-			if inFill == True or inStroke == True:
-				hit = path
-			self.cr.fill()
-		
-		return hit
-		
-	
-	
-		
-		
-
-		
-	def openFile(self):
-		if self.infos["file"] != False:
-			
-
-			
-			# rectangle for the image
-			posx, posy = self.imagePos
-			posx = posx - self.infos["imageWidth"]/2
-			posy = posy - self.infos["imageHeight"]/2
-			
-			posxB = posx + self.infos["imageWidth"]/2
-			posyB = posy + self.infos["imageHeight"]/2
-			
-			
-
-			#self.cr.translate(posxB,posyB)
-			
-			# rotate canvas?
-			self.cr.rotate(self.infos["rotate"])
-			
-			self.cr.rectangle(posx, posy,self.infos["imageWidth"],self.infos["imageHeight"])
-			# copy path
-			self.imagePath = self.cr.copy_path()
-
-			
-			# create image
-			imgformat 		= cairo.FORMAT_RGB24
-			imageSurface 	= cairo.ImageSurface( imgformat, self.infos["imageWidth"],self.infos["imageHeight"])
-			stride 			= cairo.ImageSurface.format_stride_for_width(imgformat, self.infos["imageWidth"])		
-			# new wx load method:
-			imageSurface = wx.lib.wxcairo.ImageSurfaceFromBitmap(self.infos['wxBitmap'])
-			#image 			= imageSurface.create_for_data(self.infos["imageData"], imgformat, self.infos["imageWidth"], self.infos["imageHeight"],stride)
-			
-			self.cr.set_source_surface(imageSurface,posx,posy)
-			
-			# paint the image
-			self.cr.paint()
-			self.cr.stroke()
-			
-			# rotate back!
-			self.cr.rotate(-self.infos["rotate"])
-
-
-
-	# Ladders
-	def drawLadder(self):
-		# settings
-		unit 		= self.infos["unit"]
-		self.cr.select_font_face(self.infos['fontfamily'], self.infos['fontstyle'], self.infos['fontweight'])
-		self.cr.set_font_size(self.px2Dist(self.ladderFontSize) ); #px
-		self.cr.set_source_rgb (0,0,0)
-				
-		# main loop
-		for ladder in self.drawnLadders:
-			name 		= ladder[0]
-			start 		= ladder[1]
-			stop  		= ladder[2]
-			
-			# where are the fragments on the gel?
-			positions 	= ladder[3]	
-
-			# get middle x range for lines:
-			if len(positions) > 0:
-				averageX = sum(v[0] for v in positions)/len(positions)
-				#averageX = sum(xpositions)/len(xpositions)
-			else:
-				averageX = 0
-			
-			# fragments of ladder
-			fragments = self.ladders[name]
-			lines = sorted(fragments, reverse=True)	# sort the ladder
-		
-			
-		
-			# get the largest and smalles dna fragment
-			small  = lines[len(lines)-1]
-			large = lines[0]
-		
-			# we need m and n of the linear function y = m*log(x)+n
-
-			m = (stop[1] - start[1])/(math.log10(small)-math.log10(large))
-			n = start[1] - m * math.log10(large)
-			
-
-			i = 0
-			for l in lines:
-			
-				# if kilo add a point:
-				if unit[:1] == "k":
-					num = str(round(float(l)/float(1000),2))
-					parts = num.split(".")
-					number = "%s.%s" % (parts[0],parts[1])
-				else:
-					number = str(l)
-				text = "%s %s" % (number, unit)
-				
-				position = m * math.log10(l) + n							# position of the line
-				
-				# only draw if we did not yet specify the bands
-				# or if there is one by click!
-				if len(positions) == 0 or i < len(positions):
-					
-					xbearing, ybearing, TextWidth, TextHeight, xadvance, yadvance = self.cr.text_extents(text)
-					
-					# check if ladder is to be drawn right or left:
-					if averageX >= start[0]:
-						# it is left of the image:
-						ladderSite=True
-					
-						self.cr.move_to(start[0]-TextWidth,position); 
-					else:
-						self.cr.move_to(start[0],position); 
-						ladderSite=False
-					
-					self.cr.show_text(text)
-					#self.cr.show_glyphs(text)
-					
-					if i <= len(positions) and len(positions) > 0:
-						# also draw the line for this fragment
-						self.cr.set_source_rgb(0,0,0) # Solid color
-						self.cr.set_line_width(self.px2Dist(1)) # or 0.1
-						if ladderSite:
-							self.cr.move_to(start[0]+self.px2Dist(3),position-TextHeight/4)
-							self.cr.line_to(start[0]+self.px2Dist(7),position-TextHeight/4)
-							self.cr.line_to(averageX-self.px2Dist(8),positions[i][1])						
-							self.cr.line_to(averageX,positions[i][1])
-						else:
-							self.cr.move_to(start[0]-self.px2Dist(3),position-TextHeight/4)
-							self.cr.line_to(start[0]-self.px2Dist(7),position-TextHeight/4)
-							self.cr.line_to(averageX+self.px2Dist(8),positions[i][1])						
-							self.cr.line_to(averageX,positions[i][1])
-						self.cr.stroke()
-					
-				
-				i = i+1
-
-
-		return True
-	
-	def drawCrop(self):
-
-		# depending on the values we draw 4 white boxes:
-		# upper white box
-		if self.imageCrop != False:
-			
-			posX1 = self.imageCrop[0][0]
-			posY1 = self.imageCrop[0][1]
-			
-			posX2 = self.imageCrop[1][0]
-			posY2 = self.imageCrop[1][1]
-			width, height = self.GetVirtualSize()	# set hight and width. Its 100, 100 
-			
-			
-			
-			self.cr.set_source_rgba(1,1,1,1) # Solid color
-			self.cr.set_line_width(0) # or 0.1
-			
-			# left white box
-			self.cr.rectangle(-width/2, -height/2, width/2+posX1,height)
-			self.cr.fill()
-			
-			# right box
-			self.cr.rectangle(posX2, -height/2, width/2-posX2,height)
-			self.cr.fill()
-		
-			# upper box:
-			self.cr.rectangle(-width/2, -height/2, width,height/2+posY1)
-			self.cr.fill()
-			
-			#lower
-			self.cr.rectangle(-width/2, posY2,  width,height/2-posY2)
-			self.cr.fill()
-			
-				
-		
-		
-		return True
-			
-
-	def drawLabels(self):
-		sumx =0 
-		sumy =0
-		for xy in self.laneMarkers:
-			sumx = sumx+xy[0]
-			sumy = sumy+xy[1]
-		
-		averageX = float(sumx)/len(self.laneMarkers)
-		averageY = float(sumy)/len(self.laneMarkers)
-		
-		markertype = self.infos['marks']
-		if markertype == "ABC" or markertype == "abc":
-			markerLst = labelList[markertype]
-		
-		elif markertype == "custom":
-			markerLst = self.infos['custommarks']
-		else:
-			# normal numbers
-			markerLst = range(1,len(self.laneMarkers)+1)
-		
-		i = 0
-		for pos in self.laneMarkers:
+				# the last ladder is the one being dragged
+				ladder = Ladder(self.infos["ladder"], self.dragging[0], self.dragging[1])
+				if self.tempLadder:
+					self.document.replaceLadder(-1, ladder)
+				else:
+					self.document.addLadder(ladder)
+				self.tempLadder = True
+				updateNow = True
 
-			if i >= len(markerLst):
-				newI = i-(len(markerLst))
-				A = markerLst[newI]
-				text = "%s.%d" % (A, newI+1)
-			else: 
-				text = markerLst[i]
-			# make str
-			text = str(text)
 			
-			self.cr.select_font_face(self.infos['fontfamily'], self.infos['fontstyle'], self.infos['fontweight'])
-			self.cr.set_font_size(self.px2Dist(self.ladderFontSize)); #px
-			self.cr.set_source_rgb (0,0,0)
-			xbearing, ybearing, TextWidth, TextHeight, xadvance, yadvance = self.cr.text_extents(text)
-			
-			# custom labels will no be centered, but can be rotated to fit
-			if markertype == "custom":
-				#self.infos['rotateLabel']
-				self.cr.save()
-				self.cr.move_to(pos[0], averageY)
-				self.cr.rotate(math.radians(self.infos['rotateLabel']))
-				self.cr.show_text(text)
-				self.cr.restore()		
-			else:
-				self.cr.move_to(pos[0]-TextWidth/2, averageY)
-				self.cr.show_text(text)
+			elif self.ImageClick == True and self.infos["currentAction"] == "MoveImage":	
+				# current position:
+				cx, cy = self.imagePos
+				
+				newX = cx + x2-x2Prev
+				newY = cy + y2-y2Prev
+				
+				self.imagePos = (newX, newY)
+				updateNow = True
 			
+			elif self.infos["currentAction"] == "RotateImage":	
+				# current position:
+				self.infos["rotate"] = 0.01 * (self.dragging[0][0] - self.dragging[1][0])
+				updateNow = True
+				
 			
-			i = i + 1
+			elif self.infos["currentAction"] == "CropImage":
+				self.document.setCrop((self.dragging[0], (x2,y2)))
+				self.cropDragging = True
+				updateNow = True
+				
+			elif self.infos["currentAction"]== "SelectExport":
+				# select area to export:
+				self.document.setExport((self.dragging[0], (x2,y2)))
+				updateNow = True
 				
+			#else:
+			#	print "nothing to do"
 			
+
+			if updateNow:
+				self.requestRedraw()
+		else:
+			# mark the annotations under the mouse
+			self.hoverCursor()
 		
+
+
 	
-	def selectExportRange(self):
-		''' drag and drop to select range for export'''
-		if self.drawExport:
-			x = self.imageExport[0][0]
-			y = self.imageExport[0][1]
-			width = self.imageExport[1][0]-x
-			height= self.imageExport[1][1]-y
-			
-			self.cr.set_source_rgba(0,0,0,0.8) # Solid color
-			self.cr.set_line_width(1) # or 0.1
-			self.cr.rectangle(x,y,width, height)
-			self.cr.stroke()
-		return True
-	
-	
+	def annotationAtMouse(self):
+		''' keys of the annotations under the mouse, the topmost first '''
+		x, y = self.ScreenToClient(wx.GetMousePosition())
+		return self.hitTest(*self.deviceToUser(x, y))
 	
+	def hoverCursor(self):
+		''' a hand over annotations, only changed if it differs '''
+		hover = len(self.annotationAtMouse()) > 0
+		if hover != self.hover:
+			self.hover = hover
+			if hover:
+				self.SetCursor(wx.StockCursor(wx.CURSOR_HAND))
+			else:
+				self.SetCursor(wx.NullCursor)
+		
 	
 	
+		
+		
+
+		
 	def saveFile(self):
 		print "save file"
+		self.waitForImage()
 		# show dialog
+		fileTypes = [".svg", ".png", ".pdf"]
 		saveFileDialog = wx.FileDialog(self, "Save your image file", "", self.infos["path"],
-				                       "Image files (*.svg)|*.svg;", wx.FD_SAVE )
+				                       "SVG files (*.svg)|*.svg|PNG files (*.png)|*.png|PDF files (*.pdf)|*.pdf", wx.FD_SAVE )
 		# check if file was opened
 		if saveFileDialog.ShowModal() == wx.ID_CANCEL:
 			return     # the user changed idea...
@@ -690,107 +3061,135 @@ class DrawingArea(BufferedWindow):
 		# proceed loading the file chosen by the user
 		# this can be done with e.g. wxPython input streams:
 		self.infos["fileExport"] = saveFileDialog.GetPath()
-		# add .svg
-		if self.infos["fileExport"][-4:] != ".svg" and self.infos["fileExport"][-4:] != ".SVG":
-			self.infos["fileExport"] = "%s%s" %(self.infos["fileExport"],".svg")
-		
-		#self.saveSnapshot()
-		self.exportAs(self.infos["fileExport"])
+		# add the extension of the selected type
+		fileType = os.path.splitext(self.infos["fileExport"])[1].lower()
+		if fileType not in fileTypes:
+			fileType = fileTypes[saveFileDialog.GetFilterIndex()]
+			self.infos["fileExport"] = "%s%s" %(self.infos["fileExport"],fileType)
+		
+		dpi = EXPORT_DPI
+		if fileType == ".png":
+			# the png has to fit into one cairo surface
+			left, top, right, bottom = self.exportExtents()
+			largest = max(1, int(PNG_MAX_SIZE * 96.0 / max(right - left, bottom - top, 1)))
+			largest = min(2400, largest)
+			dpi = wx.GetNumberFromUser("Resolution of the exported image (at most %d dpi for this size)" % largest,
+						"dpi:", "Export", min(EXPORT_DPI, largest), min(72, largest), largest, self)
+			if dpi == -1:
+				return
+		elif fileType == ".svg" and self.selectSvgImage() == False:
+			return
+		
+		self.exportAs(self.infos["fileExport"], fileType, dpi)
 	
+	def saveSizeTable(self):
+		''' sizes of all bands, by the first ladder, as csv file '''
+		if self.infos["file"] == False or len(self.document.ladders) == 0:
+			wx.MessageBox("Put a ladder on the gel first", "Band sizes")
+			return
+		
+		kinds 	= ["piecewise", "spline", "loglinear"]
+		dialog 	= wx.SingleChoiceDialog(self, "How should the ladder be fitted?", "Band sizes",
+					["straight lines between the ladder bands", "smooth curve through the ladder bands",
+					 "one straight line (log-linear)"])
+		if dialog.ShowModal() == wx.ID_CANCEL:
+			return
+		kind = kinds[dialog.GetSelection()]
+		
+		saveFileDialog = wx.FileDialog(self, "Save the band sizes", "", self.infos["path"],
+				                       "CSV files (*.csv)|*.csv", wx.FD_SAVE )
+		if saveFileDialog.ShowModal() == wx.ID_CANCEL:
+			return
+		path = saveFileDialog.GetPath()
+		if os.path.splitext(path)[1].lower() != ".csv":
+			path = "%s.csv" % path
+		
+		try:
+			rows = self.writeSizeTable(path, 0, kind)
+		except (ValueError, IOError) as e:
+			wx.MessageBox("Could not write the band sizes: %s" % e, "Band sizes")
+			return
+		self.notify("%d bands written to %s" % (len(rows), path))
 	
-	def exportAs(self, filepath, fileType=".svg"):
-		'''	This method is similar to update_ownUI only that it 
-			exports a file
-			it makes a surface as svg instead of wx.dc
-		'''
-		# create new surface:
-		fo = file(filepath, 'w')
-		width, height = self.GetVirtualSize()	 # set to 1000x1000, can be anything
-		
-		if fileType==".svg":
-			surface = cairo.SVGSurface (fo, width, height)
-		#elif fileType==".png":
-			# does not work yet!
-			#surface = cairo.ImageSurface(fo, width, height) 
-		else:
+	def selectSvgImage(self):
+		''' asks how the image should be stored in the svg file '''
+		codecs 	= ["png", "jpeg", "downsample", "link"]
+		choices = ["embed as png (lossless)", "embed as jpeg (small)",
+					"embed downsampled png", "link to an extra png file"]
+		options = dict(SVG_IMAGE)
+		options.update(self.infos.get("svgImage", {}))
+		
+		dialog = wx.SingleChoiceDialog(self, "How should the image be stored?", "Export svg", choices)
+		dialog.SetSelection(codecs.index(options["codec"]))
+		if dialog.ShowModal() == wx.ID_CANCEL:
 			return False
-
-		ctx = cairo.Context(surface)
-		
-		
-		self.ExportSVG(ctx)
-		#surface.finish()
-		self.updateGUI()
+		options["codec"] = codecs[dialog.GetSelection()]
+		
+		if options["codec"] == "jpeg":
+			quality = wx.GetNumberFromUser("Quality of the jpeg image", "quality:", "Export svg", options["quality"], 1, 100, self)
+			if quality == -1:
+				return False
+			options["quality"] = quality
+		elif options["codec"] == "downsample":
+			factor = wx.GetNumberFromUser("Make the image smaller by", "factor:", "Export svg", options["downsample"], 1, 16, self)
+			if factor == -1:
+				return False
+			options["downsample"] = factor
+		
+		self.infos["svgImage"] = options
 		return True
 	
+	def viewExtents(self):
+		''' the part of the canvas that is visible in the window, in user space '''
+		width, height 	= self.canvasSize()
+		sx, sy 			= self.scroll
+		return (-width/2.0/self.zoom - sx, -height/2.0/self.zoom - sy,
+				 width/2.0/self.zoom - sx,  height/2.0/self.zoom - sy)
 	
-	def saveSnapshot(self):
-		dcSource = self.dc
-		# based largely on code posted to wxpython-users by Andrea Gavana 2006-11-08
-		if self.imageExport == False:
-			#no crop:
-			size = dcSource.Size
-			width = size.width
-			height = size.height
-			offx=0
-			offy=0
+	def exportAs(self, filepath, fileType=".svg", dpi=EXPORT_DPI):
+		'''	renders the selected export range, or the visible part of the
+			canvas, directly to a svg, pdf or png file.
+			Nothing is taken from the screen, so the resolution only
+			depends on dpi (for png)
+		'''
+		extents = self.exportExtents()
+		if fileType == ".png":
+			scale = dpi/96.0
+		elif fileType == ".pdf":
+			scale = 72/96.0		# pdf units are points
 		else:
-			#size should be calculatet here!
-			size = dcSource.Size
-			x = self.imageExport[0][0]
-			y = self.imageExport[0][1]
-			
-			x2 = self.imageExport[1][0]
-			y2 = self.imageExport[1][1]
-			
-			offx, offy	= self.cr.user_to_device(x,y)
-			 
-			width 	= x2-x
-			height 	= y2-y
-				
-
-		# Create a Bitmap that will later on hold the screenshot image
-		# Note that the Bitmap must have a size big enough to hold the screenshot
-		# -1 means using the current default colour depth
-		bmp = wx.EmptyBitmap(width, height)
-
-		# Create a memory DC that will be used for actually taking the screenshot
-		memDC = wx.MemoryDC()
-
-		# Tell the memory DC to use our Bitmap
-		# all drawing action on the memory DC will go to the Bitmap now
-		memDC.SelectObject(bmp)
-
-		# Blit (in this case copy) the actual screen on the memory DC
-		# and thus the Bitmap
-		memDC.Blit( 0, # Copy to this X coordinate
-			0, # Copy to this Y coordinate
-			width, # Copy this width
-			height, # Copy this height
-			dcSource, # From where do we copy?
-			offx, # What's the X offset in the original DC?
-			offy  # What's the Y offset in the original DC?
-			)
-
-		# Select the Bitmap out of the memory DC by selecting a new
-		# uninitialized Bitmap
-		memDC.SelectObject(wx.NullBitmap)
-
-		img = bmp.ConvertToImage()
-		img.SaveFile(self.infos["fileExport"], wx.BITMAP_TYPE_PNG)
-
-
+			scale = 1
+		
+		try:
+			written = self.writeFile(filepath, extents, scale)
+		except (ValueError, IOError, MemoryError, cairo.Error) as error:
+			wx.MessageBox("Could not export the image: %s" % error, "Export")
+			written = False
+		if written != False:
+			self.notify("exported %s (%s)" % (", ".join(written), fileSize(written)))
+		
 		# reset variable
-		self.imageExport = False
+		self.document.setExport(False)
+		self.updateGUI()
+		return written != False
+	
+	def exportExtents(self):
+		''' the selected export range, or the visible part of the canvas, in user space '''
+		if self.document.export != False:
+			(x1, y1), (x2, y2) = self.document.export
+			return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+		return self.viewExtents()
 	
 	# to remove ladders if wished
 	def removeLadders(self):
-		self.drawnLadders = []
+		self.document.removeLadders()
+		self.checkpoint()
 		self.infos["currentAction"] = False
 		return True
 	
 	def remLabels(self):
-		self.laneMarkers = []
+		self.document.setLaneMarkers([])
+		self.checkpoint()
 		self.infos["currentAction"] = False
 		return True
 
@@ -808,7 +3207,57 @@ class DrawingArea(BufferedWindow):
 
 
 
-class gelImage(wx.Frame):
+class LevelsDialog(DialogBase):
+	'''	Sliders for black point, white point and gamma.
+		Every change only makes a new lookup table, the histogram
+		is computed once when the dialog opens.
+	'''
+	def __init__(self, parent, pixels, area):
+		wx.Dialog.__init__(self, parent, title="Levels")
+		self.pixels = pixels
+		self.area 	= area
+		
+		maxLevel 		= pixels.maxLevel()
+		black, white 	= pixels.autoLevels()
+		
+		self.black 	= wx.Slider(self, value=black, minValue=0, maxValue=maxLevel, size=(300, -1), style=wx.SL_HORIZONTAL|wx.SL_LABELS)
+		self.white 	= wx.Slider(self, value=white, minValue=0, maxValue=maxLevel, size=(300, -1), style=wx.SL_HORIZONTAL|wx.SL_LABELS)
+		self.gamma 	= wx.Slider(self, value=100, minValue=10, maxValue=400, size=(300, -1), style=wx.SL_HORIZONTAL|wx.SL_LABELS)
+		for slider in (self.black, self.white, self.gamma):
+			slider.Bind(wx.EVT_SCROLL, self.OnSliderScroll)
+		
+		auto = wx.Button(self, -1, "auto")
+		auto.Bind(wx.EVT_BUTTON, self.OnAuto)
+		
+		box = wx.BoxSizer(wx.VERTICAL)
+		for label, slider in (("black:", self.black), ("white:", self.white), ("gamma (percent):", self.gamma)):
+			box.Add(wx.StaticText(self, -1, label))
+			box.Add(slider)
+		box.Add(auto)
+		box.Add(self.CreateButtonSizer(wx.OK|wx.CANCEL))
+		self.SetSizerAndFit(box)
+		
+		self.apply()
+	
+	def apply(self):
+		white = max(self.white.GetValue(), self.black.GetValue() + 1)
+		self.pixels.levels(self.black.GetValue(), white, self.gamma.GetValue() / 100.0)
+		self.area.imageChanged()
+		self.area.requestRedraw()
+	
+	def OnSliderScroll(self, e):
+		self.apply()
+	
+	def OnAuto(self, e):
+		black, white = self.pixels.autoLevels()
+		self.black.SetValue(black)
+		self.white.SetValue(white)
+		self.gamma.SetValue(100)
+		self.apply()
+
+
+
+class gelImage(FrameBase):
 	'''
 		Base class of the script.
 		Inits gui and handles user input
@@ -834,25 +3283,30 @@ class gelImage(wx.Frame):
 						"font": sFont,
 						"rotateLabel": 0}
 		
-		self.StartInfos = self.infos
-		
-		# some ladders, feel free to add some
-		self.ladders = {"Eurogentec smartLadder":[10000,8000,6000,5000,4000,3000,2500,2000,1500,1000,800,600],
-						"NEB 1 kb DNA Ladder":[10000,8000,6000,5000,4000,3000,2000,1500,1000,500],
-						"NEB Low Molecular Weight DNA Ladder":[766,500,350,300,250,200,150,100,75,50,25],
-						"Thermo Scientific GeneRuler DNA Ladder Mix": [10000,8000,6000,5000,4000,3500,3000,2500,2000,1500,1200,1000,900,800,700,600,500,400,300,200,100],
-						"Thermo Scientific GeneRuler 100 bp DNA Ladder ": [1000,900,800,700,600,500,400,300,200,100],
-						"Invitrogen 1 Kb Plus DNA Ladder": [12000,5000,2000,1650,1000,850,650,500,400,300,200,100],
-						"NEB Purple 2-Log DNA Ladder": [10000,8000,6000,5000,4000,3000,2000,1500,1200,1000,900,800,700,600,500,400,300,200,100],
-						"Ultra Low Range DNA-Leiter II (peqlab)":[700,500,400,300,200,150,100,75,50,25]}
+		# state that belongs to an image, it is reset when another one is opened.
+		# a copy, so the values stay as they are while self.infos changes
+		self.StartInfos = {"file": False, "currentAction": None, "rotate": 0, "bakedRotate": 0, "imageHash": False}
+		
+		# the project file of the image, changes are saved automatically
+		self.project = False
+		self.projectHash = False
+		self.autosaveFailed = False
+		
+		# some ladders, feel free to add some at the top of the file
+		self.ladders = dict(LADDERS)
 						
-		self.units = ["bp","kbp","Da","kDa","u","ku"]
+		self.units = list(UNITS)
 
 
 			
 		
 		self.InitUI()
 		
+		self.autosaveTimer = wx.Timer(self)
+		self.Bind(wx.EVT_TIMER, self.OnAutosave, self.autosaveTimer)
+		self.autosaveTimer.Start(AUTOSAVE_SECONDS * 1000)
+		self.Bind(wx.EVT_CLOSE, self.OnClose)
+		
 	def updateGUI(self):
 		# update infos if changed
 		self.infos = self.cairo.returnInfo()
@@ -873,6 +3327,14 @@ class gelImage(wx.Frame):
 		fileMenu.AppendItem(open_file)
 		self.Bind(wx.EVT_MENU, self.OnOpen, open_file)
 		
+		open_file = wx.MenuItem(fileMenu, wx.ID_ANY, 'Open Project\tCTRL+SHIFT+O')
+		fileMenu.AppendItem(open_file)
+		self.Bind(wx.EVT_MENU, self.OnOpenProject, open_file)
+		
+		save_file = wx.MenuItem(fileMenu, wx.ID_ANY, 'Save Project as\tCTRL+ALT+S')
+		fileMenu.AppendItem(save_file)
+		self.Bind(wx.EVT_MENU, self.OnSaveProject, save_file)
+		
 		save_file = wx.MenuItem(fileMenu, wx.ID_ANY, 'Save Image\tCTRL+S')
 		fileMenu.AppendItem(save_file)
 		self.Bind(wx.EVT_MENU, self.OnSave, save_file)
@@ -881,6 +3343,10 @@ class gelImage(wx.Frame):
 		fileMenu.AppendItem(save_file)
 		self.Bind(wx.EVT_MENU, self.selectExport, save_file)
 		
+		save_file = wx.MenuItem(fileMenu, wx.ID_ANY, 'Save band sizes\tCTRL+T')
+		fileMenu.AppendItem(save_file)
+		self.Bind(wx.EVT_MENU, self.OnSaveSizes, save_file)
+		
 		
 		menubar.Append(fileMenu, '&File')  
 		
@@ -888,10 +3354,23 @@ class gelImage(wx.Frame):
 		# edit menu
 		editMenu = wx.Menu()
 		
+		action = wx.MenuItem(editMenu, wx.ID_UNDO, 'Undo\tCTRL+Z')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.undo, action)
+		
+		action = wx.MenuItem(editMenu, wx.ID_REDO, 'Redo\tCTRL+Y')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.redo, action)
+		editMenu.AppendSeparator()
+		
 		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Put Ladder\tCTRL+L')
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.PutLadder, action)
 		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Detect ladder bands\tCTRL+SHIFT+L')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.detectBands, action)
+		
 		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Move Image\tCTRL+M')
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.MoveImage, action)
@@ -904,11 +3383,34 @@ class gelImage(wx.Frame):
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.grayScale, action)
 		
+		channelMenu = wx.Menu()
+		for index, name in enumerate(["red", "green", "blue"]):
+			action = wx.MenuItem(channelMenu, wx.ID_ANY, 'Use %s channel' % name)
+			channelMenu.AppendItem(action)
+			self.Bind(wx.EVT_MENU, lambda e, index=index: self.useChannel(index), action)
+		editMenu.AppendMenu(wx.ID_ANY, 'Extract channel', channelMenu)
+		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Brightness/Contrast\tCTRL+B')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.brightnessContrast, action)
+		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Auto levels\tCTRL+SHIFT+E')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.autoLevels, action)
+		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Levels\tCTRL+E')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.levels, action)
+		
 		
 		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Rotate Image\tCTRL+R')
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.rotateImage, action)
 		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Straighten Image\tCTRL+SHIFT+R')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.deskew, action)
+		
 		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Crop Image\tCTRL+K')
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.crop, action)
@@ -917,6 +3419,10 @@ class gelImage(wx.Frame):
 		editMenu.AppendItem(action)
 		self.Bind(wx.EVT_MENU, self.labelLanes, action)
 		
+		action = wx.MenuItem(editMenu, wx.ID_ANY, 'Detect lanes\tCTRL+SHIFT+J')
+		editMenu.AppendItem(action)
+		self.Bind(wx.EVT_MENU, self.detectLanes, action)
+		
 		menubar.Append(editMenu, 'Edit') 
 		    
 
@@ -928,6 +3434,9 @@ class gelImage(wx.Frame):
 		menubar.Append(helpMenu, '&Help')     
 
 		self.SetMenuBar(menubar)
+		
+		# messages that need no answer, like what was exported
+		self.CreateStatusBar()
 
 		#----------------------------------------------------
 		# Build window layout
@@ -1073,9 +3582,6 @@ class gelImage(wx.Frame):
 		self.Close()
 		
 	def OnOpen(self, e):
-		# reset settings:
-		self.infos = self.StartInfos
-		
 		# show dialog
 		openFileDialog = wx.FileDialog(self, "Open image file", "", "",
 				                       "Image files (*.png, *.TIF, *.jpg)|*.png;*.PNG;*.tif;*.TIF;*.tiff;*.TIFF;*.jpg;*.JPG;*.jpeg;*.JPEG;", wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
@@ -1083,10 +3589,28 @@ class gelImage(wx.Frame):
 		# check if file was opened
 		if openFileDialog.ShowModal() == wx.ID_CANCEL:
 			return     # the user changed idea...
-
+		
+		return self.openImage(openFileDialog.GetPath())
+	
+	def openImage(self, path, project=False):
+		'''	loads an image. Its annotations are restored from the project,
+			or from the project file next to the image if there is one
+		'''
+		# save the work on the last image
+		self.OnAutosave(None)
+		
+		# stop reading the last image
+		if self.cairo.loader is not False:
+			self.cairo.loader.cancel()
+			self.cairo.loader = False
+		
+		# reset settings and annotations of the last image:
+		self.infos.update(self.StartInfos)
+		self.cairo.newDocument()
+		
 		# proceed loading the file chosen by the user
 		# this can be done with e.g. wxPython input streams:
-		self.infos["file"] = (openFileDialog.GetPath())
+		self.infos["file"] = path
 		fileName, fileExtension = os.path.splitext(self.infos["file"])
 		
 		# read file
@@ -1099,23 +3623,30 @@ class gelImage(wx.Frame):
 		
 		# try opening Tiff files with outher
 		if fileExtension in [".tif", ".tiff", ".TIF", ".TIFF"]:
-			self.infos['wxBitmap'] 	= wx.Bitmap(self.infos["file"], wx.BITMAP_TYPE_TIF)
-			#wx.Image(self.infos["file"], wx.BITMAP_TYPE_TIF)
+			imageType = wx.BITMAP_TYPE_TIF
 		elif fileExtension in [".png", ".PNG"]:
-			self.infos['wxBitmap'] = wx.Bitmap(self.infos["file"], wx.BITMAP_TYPE_PNG)
+			imageType = wx.BITMAP_TYPE_PNG
 		elif fileExtension in [".jpg", ".JPG", ".jpeg", ".JPEG"]:
-			self.infos['wxBitmap'] = wx.Bitmap(self.infos["file"], wx.BITMAP_TYPE_JPEG)
-		
-		# make an platform independent image out of the file
-		# with this we can perform further calculations
-		# like inverting it or make it grayscale
-		self.infos['wxImage'] 	= self.infos['wxBitmap'].ConvertToImage() 
-		
-		self.infos["imageWidth"] = self.infos['wxImage'] .GetWidth()
-		self.infos["imageHeight"] = self.infos['wxImage'] .GetHeight()
+			imageType = wx.BITMAP_TYPE_JPEG
+		
+		# the pixels are kept in a numpy array, with this we can perform
+		# further calculations like inverting it or make it grayscale
+		# uncompressed tiff files are memory mapped, to keep 16 bit data.
+		# Large images are read by a worker, a preview is shown until then
+		loader 	= ImageLoader(self.infos["file"], imageType, self.imageLoaded, self.loadProgress)
+		preview = loader.preview()
+		self.infos['pixels'] = preview
+		if preview is not False:
+			self.infos["imageWidth"] = loader.width
+			self.infos["imageHeight"] = loader.height
+			self.cairo.loader = loader
+			loader.start()
 		
 		#self.infos["image_original"] = self.infos["image"]
 		
+		# new image, so the cached surface is outdated
+		self.cairo.invalidateImage()
+		
 		# set mode to move image
 		self.infos["currentAction"]="MoveImage"
 
@@ -1129,14 +3660,169 @@ class gelImage(wx.Frame):
 		# set name
 		self.SetTitle("gelImage - %s" % (self.infos['filename']))
 		
+		# restore the annotations, the hash of the image is checked when it is read
+		self.projectHash = False
+		if project == False:
+			project = ProjectFile(self.infos["file"] + PROJECT_EXTENSION)
+		if os.path.exists(project.path):
+			try:
+				state = project.load()
+			except (IOError, ValueError) as e:
+				wx.MessageBox("Could not read the project %s: %s" % (project.path, e), "Open image")
+			else:
+				self.projectHash = state.get("imageHash", False)
+				self.infos["imageHash"] = self.projectHash
+				self.cairo.applyProjectState(state)
+				self.cairo.invalidateImage()
+				self.cairo.rotatePixels(self.infos["bakedRotate"])
+				self.syncControls()
+				self.SetStatusText("annotations restored from %s" % project.path)
+		else:
+			# no file for an image that is only looked at
+			project.begin(self.cairo.projectState(os.path.dirname(os.path.abspath(project.path))))
+		self.project = project
+		self.autosaveFailed = False
+		
+		if preview is False:
+			# small image, read it at once
+			loader.run()
+			loader.finish()
+		else:
+			self.loadProgress(0)
 
 		# update GUI
 		self.updateGUI()
+	
+	def imageLoaded(self, loader):
+		''' the full image was read by the loader, it replaces the preview '''
+		if self.cairo.loader is loader:
+			self.cairo.loader = False
+		
+		if loader.error is not False:
+			wx.MessageBox("Could not read %s: %s" % (loader.path, loader.error), "Open image")
+			self.project = False
+			self.infos.update(self.StartInfos)
+			self.cairo.newDocument()
+			self.infos['pixels'] = False
+			self.cairo.invalidateImage()
+			self.SetTitle("gelImage")
+			self.updateGUI()
+			return
+		
+		self.infos['pixels'] 		= loader.pixels
+		self.infos["imageWidth"] 	= loader.pixels.width
+		self.infos["imageHeight"] 	= loader.pixels.height
+		self.infos["imageHash"] 	= loader.imageHash
+		self.cairo.invalidateImage()
+		self.cairo.rotatePixels(self.infos["bakedRotate"])
+		self.SetTitle("gelImage - %s" % (self.infos['filename']))
+		
+		if self.projectHash not in (False, None, loader.imageHash):
+			wx.MessageBox("The image has changed since the project was saved", "Open project")
+		# the hash is not a change of a project that is not saved yet
+		if self.project != False and self.project.state is not False and not os.path.exists(self.project.path):
+			self.project.state["imageHash"] = loader.imageHash
+		
+		self.updateGUI()
+	
+	def loadProgress(self, percent):
+		self.SetTitle("gelImage - %s (reading %d%%)" % (self.infos['filename'], percent))
+	
+	def imageReady(self):
+		''' True if there is an image, waits until it is read completely '''
+		if self.infos["file"] == False:
+			return False
+		self.cairo.waitForImage()
+		return self.infos["file"] != False
 		
 	
 	def OnSave(self, e):
 		self.cairo.saveFile()
 	
+	def OnOpenProject(self, e):
+		openFileDialog = wx.FileDialog(self, "Open project", self.infos["path"], "",
+				                       "gelImage projects (*%s)|*%s" % (PROJECT_EXTENSION, PROJECT_EXTENSION), wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+		if openFileDialog.ShowModal() == wx.ID_CANCEL:
+			return
+		
+		project = ProjectFile(openFileDialog.GetPath())
+		try:
+			state = project.load()
+		except (IOError, ValueError) as e:
+			wx.MessageBox("Could not read the project: %s" % e, "Open project")
+			return
+		
+		image = os.path.join(os.path.dirname(project.path), state.get("image") or "")
+		if not os.path.isfile(image):
+			wx.MessageBox("The image of the project is missing: %s" % image, "Open project")
+			return
+		self.openImage(image, project)
+	
+	def OnSaveProject(self, e):
+		if self.infos["file"] == False:
+			return
+		saveFileDialog = wx.FileDialog(self, "Save project", self.infos["path"], self.infos["filename"] + PROJECT_EXTENSION,
+				                       "gelImage projects (*%s)|*%s" % (PROJECT_EXTENSION, PROJECT_EXTENSION), wx.FD_SAVE)
+		if saveFileDialog.ShowModal() == wx.ID_CANCEL:
+			return
+		path = saveFileDialog.GetPath()
+		if not path.endswith(PROJECT_EXTENSION):
+			path = path + PROJECT_EXTENSION
+		
+		project = ProjectFile(path)
+		try:
+			project.save(self.cairo.projectState(os.path.dirname(path)))
+		except (IOError, OSError) as error:
+			wx.MessageBox("Could not save the project to %s: %s" % (path, error), "Save project")
+			return
+		self.project = project
+		self.autosaveFailed = False
+		self.SetStatusText("project saved to %s" % path)
+	
+	def OnAutosave(self, e):
+		''' appends the changes to the project file, if there are any '''
+		if self.project == False or self.infos["file"] == False:
+			return
+		try:
+			self.project.autosave(self.cairo.projectState(os.path.dirname(os.path.abspath(self.project.path))))
+		except (IOError, OSError) as error:
+			# read only folder, full disk or a removed stick. The project is
+			# kept and tried again, the user is told once until it works.
+			# The flag is set first, the timer fires while the box is open
+			if self.autosaveFailed == False:
+				self.autosaveFailed = True
+				wx.MessageBox("Could not save the annotations to %s: %s\n\n"
+							  "It is tried again every %d seconds. Use Save project to save them somewhere else."
+							  % (self.project.path, error, AUTOSAVE_SECONDS), "Autosave")
+			return
+		self.autosaveFailed = False
+	
+	def OnClose(self, e):
+		if self.cairo.loader is not False:
+			self.cairo.loader.cancel()
+		self.autosaveTimer.Stop()
+		# last chance, tell the user again if it still fails
+		self.autosaveFailed = False
+		self.OnAutosave(None)
+		e.Skip()
+	
+	def syncControls(self):
+		''' shows the values of self.infos in the controls, after a project was loaded '''
+		self.unitSelect.SetStringSelection(self.infos["unit"])
+		self.labelSelect.SetStringSelection(self.infos["marks"])
+		self.customlabels.ChangeValue("\n".join(self.infos["custommarks"]))
+		self.rotateLabel.SetValue(int(self.infos["rotateLabel"]))
+		self.rotateTxt.SetLabel("%s degree" % self.infos["rotateLabel"])
+		
+		style 	= wx.FONTSTYLE_ITALIC if self.infos["fontstyle"] == cairo.FONT_SLANT_ITALIC else wx.FONTSTYLE_NORMAL
+		weight 	= wx.FONTWEIGHT_BOLD if self.infos["fontweight"] == cairo.FONT_WEIGHT_BOLD else wx.FONTWEIGHT_NORMAL
+		self.infos["font"] = wx.Font(self.infos["fontsize"], wx.FONTFAMILY_DEFAULT, style, weight, False, self.infos["fontfamily"])
+	
+	def OnSaveSizes(self, e):
+		if not self.imageReady():
+			return False
+		self.cairo.saveSizeTable()
+	
 
 
 
@@ -1146,43 +3832,77 @@ class gelImage(wx.Frame):
 
 	
 	def invertImage(self, e):
+		if not self.imageReady():
+			return False
 		
-		# get the image
-		#self.infos['wxImage'] = self.infos['wxImage'].ConvertToGreyscale()
-		#self.infos['wxImage'] = self.infos['wxImage'].AdjustChannels(-1,-1,-1,1)
-
-		#depth 					= self.infos['wxBitmap'].GetDepth()
-
-		image = self.infos['wxImage']
-		print "inverting is not working"
-		#print image.GetData()
-		'''
-		if image.mode == 'RGBA':
-			r,g,b,a 		= image.split()
-			rgb_image 		= Image.merge('RGB', (r,g,b))
-			inverted_image 	= PIL.ImageOps.invert(rgb_image)
-			r2,g2,b2 		= inverted_image.split()
-			image 			= Image.merge('RGBA', (r2,g2,b2,a))
-		else:
-			image = PIL.ImageOps.invert(image)
+		self.infos['pixels'].invert()
+		self.cairo.imageChanged()
+		self.updateGUI()
+		
+		return True
+	
+	def grayScale(self,e):
+		if not self.imageReady():
+			return False
 		
+		self.infos['pixels'].grayscale()
+		self.cairo.imageChanged()
 		
-		self.infos['wxImage'] 	= self.PilImageToWxImage(image)
-		#set the image bitmap
-		self.infos['wxBitmap'] 	= self.infos['wxImage'].ConvertToBitmap(24) # 24 because we losse bit depth in the conversion from image to PIl
-		# should be improved!!!
+		self.updateGUI()
+		return True
 	
-		'''
+	def useChannel(self, index):
+		if not self.imageReady():
+			return False
+		
+		self.infos['pixels'].channel(index)
+		self.cairo.imageChanged()
 		self.updateGUI()
+		return True
+	
+	def brightnessContrast(self, e):
+		if not self.imageReady():
+			return False
+		
+		brightness = wx.GetNumberFromUser("Change the brightness by", "brightness:", "Brightness/Contrast", 0, -255, 255, self)
+		if brightness == -1:
+			return False
+		contrast = wx.GetNumberFromUser("Contrast in percent", "contrast:", "Brightness/Contrast", 100, 0, 1000, self)
+		if contrast == -1:
+			return False
 		
+		self.infos['pixels'].brightnessContrast(brightness, contrast/100.0)
+		self.cairo.imageChanged()
+		self.updateGUI()
 		return True
 	
-	def grayScale(self,e):
-		self.infos['wxImage'] 	= self.infos['wxImage'].ConvertToGreyscale()
-		#set the image bitmap
-		self.infos['wxBitmap'] 	= self.infos['wxImage'].ConvertToBitmap(self.infos['wxBitmap'].GetDepth())
+	def autoLevels(self, e):
+		if not self.imageReady():
+			return False
+		
+		self.infos['pixels'].levels()
+		self.cairo.imageChanged()
+		self.updateGUI()
+		return True
 	
+	def levels(self, e):
+		if not self.imageReady():
+			return False
 		
+		# the last applied lut, to go back on cancel
+		pixels 		= self.infos['pixels']
+		previous 	= pixels.lut
+		dialog 		= LevelsDialog(self, pixels, self.cairo)
+		if dialog.ShowModal() != wx.ID_OK:
+			if previous[0] is not False:
+				pixels.lut = previous
+				pixels.showThrough(previous[1], pixels.levelSource())
+			elif pixels.rawShown:
+				pixels.showRaw()
+			else:
+				pixels.levels(0, 255)
+			self.cairo.imageChanged()
+		dialog.Destroy()
 		self.updateGUI()
 		return True
 
@@ -1192,6 +3912,24 @@ class gelImage(wx.Frame):
 		
 		return False
 	
+	def deskew(self, e):
+		if not self.imageReady():
+			return False
+		
+		self.cairo.deskew()
+		self.updateGUI()
+		return True
+	
+	def undo(self, e):
+		if self.cairo.undo():
+			self.updateGUI()
+		return True
+	
+	def redo(self, e):
+		if self.cairo.redo():
+			self.updateGUI()
+		return True
+	
 	def PutLadder(self, e):
 		self.infos["currentAction"]="addLadder"
 		return True
@@ -1208,6 +3946,27 @@ class gelImage(wx.Frame):
 	def labelLanes(self,e):
 		self.infos["currentAction"]="LabelLanes"
 		return True
+	
+	def detectBands(self, e):
+		''' bands of the last placed ladder '''
+		if not self.imageReady():
+			return False
+		
+		self.cairo.detectBands()
+		self.cairo.checkpoint()
+		self.updateGUI()
+		return True
+	
+	def detectLanes(self, e):
+		if not self.imageReady():
+			return False
+		
+		self.cairo.detectLanes()
+		self.cairo.checkpoint()
+		# more lanes can be added by clicking
+		self.infos["currentAction"]="LabelLanes"
+		self.updateGUI()
+		return True
 
 	
 	def selectFont(self, e):
@@ -1270,7 +4029,8 @@ class gelImage(wx.Frame):
 	def customLabelChange(self, e):
 		
 		self.infos["custommarks"] = self.customlabels.GetValue().split('\n')
-		self.updateGUI()
+		# typing fast only redraws once per frame
+		self.cairo.requestRedraw()
 		e.Skip()
 	
 	def OnSliderScroll(self,e):
@@ -1294,8 +4054,525 @@ class gelImage(wx.Frame):
 
 
 
+def fontSpec(infos):
+	''' the font of infos as {"family", "size", "style", "weight"} '''
+	return {"family": infos["fontfamily"], "size": infos["fontsize"],
+			"style": "italic" if infos["fontstyle"] == cairo.FONT_SLANT_ITALIC else "normal",
+			"weight": "bold" if infos["fontweight"] == cairo.FONT_WEIGHT_BOLD else "normal"}
+
+def fontInfos(font):
+	''' the infos keys of a font given as in fontSpec '''
+	if font.get("style", "normal") == "italic":
+		fontstyle = cairo.FONT_SLANT_ITALIC
+	else:
+		fontstyle = cairo.FONT_SLANT_NORMAL
+	if font.get("weight", "normal") == "bold":
+		fontweight = cairo.FONT_WEIGHT_BOLD
+	else:
+		fontweight = cairo.FONT_WEIGHT_NORMAL
+	return {"fontfamily": font.get("family", "Arial"), "fontsize": font.get("size", 20),
+			"fontstyle": fontstyle, "fontweight": fontweight}
+
+def fileHash(path):
+	''' sha1 of the content of a file, read in blocks '''
+	sha = hashlib.sha1()
+	with open(path, "rb") as f:
+		block = f.read(1024*1024)
+		while block:
+			sha.update(block)
+			block = f.read(1024*1024)
+	return sha.hexdigest()
+
+def diffState(old, new):
+	'''	change record from one project state to the next. Lists that
+		only grew or changed in a few places store just those items
+	'''
+	record = {}
+	for key, value in new.items():
+		previous = old.get(key)
+		if previous == value:
+			continue
+		if isinstance(value, list) and isinstance(previous, list) and len(value) >= len(previous):
+			items = dict((str(i), value[i]) for i in range(len(previous)) if previous[i] != value[i])
+			if len(items) <= len(previous) / 2:
+				if items:
+					record.setdefault("items", {})[key] = items
+				if len(value) > len(previous):
+					record.setdefault("append", {})[key] = value[len(previous):]
+				continue
+		record.setdefault("set", {})[key] = value
+	removed = [key for key in old if key not in new]
+	if removed:
+		record["remove"] = removed
+	return record
+
+def applyRecord(state, record):
+	''' applies a change record of diffState to a state, in place '''
+	state.update(record.get("set", {}))
+	for key, items in record.get("items", {}).items():
+		for index, value in items.items():
+			state[key][int(index)] = value
+	for key, values in record.get("append", {}).items():
+		state[key].extend(values)
+	for key in record.get("remove", []):
+		state.pop(key, None)
+	return state
+
+def readRecords(text):
+	'''	the json values in text, one after another, and if all of the text
+		was read. A broken value at the end (from a crash while appending)
+		is left out
+	'''
+	decoder = json.JSONDecoder()
+	records = []
+	index 	= 0
+	while True:
+		while index < len(text) and text[index].isspace():
+			index += 1
+		if index >= len(text):
+			break
+		try:
+			record, index = decoder.raw_decode(text, index)
+		except ValueError:
+			return records, False
+		records.append(record)
+	return records, True
+
+def loadProject(path):
+	'''	the state of a project or spec file: the first json value and
+		all change records after it
+	'''
+	records, complete = readRecords(open(path, "rb").read().decode("utf-8"))
+	if len(records) == 0:
+		raise ValueError("%s is empty" % path)
+	state = records[0]
+	for record in records[1:]:
+		applyRecord(state, record)
+	return state
+
+class ProjectFile(object):
+	'''	A project on disk. The file starts with the whole state as json,
+		each autosave only appends a small change record. When there are
+		many records, or they are larger than the state, the file is
+		written again as a whole (compacted).
+	'''
+	def __init__(self, path):
+		self.path 			= path
+		self.state 			= False		# the state that is in the file
+		self.records 		= 0
+		self.snapshotSize 	= 0
+		self.journalSize 	= 0
+	
+	def load(self):
+		text 		= open(self.path, "rb").read().decode("utf-8")
+		records, complete = readRecords(text)
+		if len(records) == 0:
+			raise ValueError("%s is empty" % self.path)
+		self.state 	= records[0]
+		for record in records[1:]:
+			applyRecord(self.state, record)
+		self.records 		= len(records) - 1
+		self.snapshotSize 	= len(json.dumps(records[0]))
+		self.journalSize 	= len(text) - self.snapshotSize
+		if not complete:
+			# records appended after the broken one could not be read
+			self.records = PROJECT_COMPACT_RECORDS
+		return json.loads(json.dumps(self.state))		# a copy the caller can change
+	
+	def save(self, state):
+		''' writes the whole state, to a temporary file that replaces the old one '''
+		data 	= json.dumps(state, sort_keys=True)
+		folder 	= os.path.dirname(os.path.abspath(self.path))
+		handle, temp = tempfile.mkstemp(suffix=PROJECT_EXTENSION, dir=folder)
+		with os.fdopen(handle, "wb") as f:
+			f.write(data + "\n")
+		if os.name == "nt" and os.path.exists(self.path):
+			os.remove(self.path)
+		os.rename(temp, self.path)
+		
+		self.state 			= json.loads(data)
+		self.records 		= 0
+		self.snapshotSize 	= len(data)
+		self.journalSize 	= 0
+	
+	def autosave(self, state):
+		'''	appends what changed since the last save, returns False if
+			nothing changed
+		'''
+		if self.state is False:
+			self.save(state)
+			return True
+		record = diffState(self.state, state)
+		if not record:
+			return False
+		
+		data = json.dumps(record, sort_keys=True)
+		if not os.path.exists(self.path) or self.records >= PROJECT_COMPACT_RECORDS or self.journalSize + len(data) > self.snapshotSize:
+			self.save(state)
+			return True
+		with open(self.path, "ab") as f:
+			f.write(data + "\n")
+		applyRecord(self.state, json.loads(data))
+		self.records 		= self.records + 1
+		self.journalSize 	= self.journalSize + len(data) + 1
+		return True
+	
+	def begin(self, state):
+		'''	the state of a new project, nothing is written until
+			autosave gets a different one
+		'''
+		self.state = json.loads(json.dumps(state))
+
+
+
+class HeadlessGel(GelPainter):
+	'''	Renders an annotated gel from a spec, without a window or wx.App.
+		The coordinates in the spec are the same as in the gelImage window:
+		the image is centered at imagePos and rotated around the origin.
+		
+		spec = {"image": "gel.png",
+				"output": "gel.svg",	# or a list, .svg .png or .pdf
+				"rotate": 0,			# radians, or "auto" to straighten the lanes
+				"bakedRotate": 0,		# radians, rotation put into the pixels (projects)
+				"imagePos": [0, 0],
+				"crop": [[x1, y1], [x2, y2]],
+				"levels": "auto",		# or [black, white, gamma]
+				"ladders": [{"name": "NEB 1 kb DNA Ladder", "start": [x, y],
+							 "stop": [x, y], "bands": [[x, y], ...]}],	# or "auto"
+				"customLadders": {"my ladder": [1000, 500, 100]},
+				"laneMarkers": [[x, y], ...],	# or "auto"
+				"marks": "ABC",			# ABC, abc, 123 or custom
+				"custommarks": ["wt", "ko"],
+				"rotateLabel": 0,		# degree, for custom labels
+				"unit": "bp",
+				"font": {"family": "Arial", "size": 20, "style": "normal", "weight": "normal"},
+				"zoom": 1,
+				"margin": 20,
+				"svgImage": {"codec": "jpeg", "quality": 90},	# or png, downsample, link
+				"sizeTable": "gel_sizes.csv",	# sizes of all bands by the first ladder
+				"calibration": "piecewise"}		# or spline, loglinear
+	'''
+	def __init__(self, spec, basePath=""):
+		GelPainter.__init__(self)
+		
+		self.ladders = dict(LADDERS)
+		self.ladders.update(spec.get("customLadders", {}))
+		
+		self.infos = {	"file": False,
+						"currentAction": None,
+						"rotate": spec.get("rotate", 0) if spec.get("rotate") != "auto" else 0,
+						"marks": spec.get("marks", "ABC"),
+						"custommarks": spec.get("custommarks", []),
+						"unit": spec.get("unit", UNITS[0]),
+						"rotateLabel": spec.get("rotateLabel", 0),
+						"svgImage": spec.get("svgImage", {})}
+		self.infos.update(fontInfos(spec.get("font", {})))
+		self.ladderFontSize = int(self.infos['fontsize'])  #px
+		
+		if spec.get("image"):
+			self.infos["file"] 	= os.path.join(basePath, spec["image"])
+			pixels 				= loadPixels(self.infos["file"])
+			if spec.get("levels") == "auto":
+				pixels.levels()
+			elif spec.get("levels"):
+				pixels.levels(*spec["levels"])
+			self.imageCache.invalidate(pixels)
+			self.infos["imageWidth"] 	= pixels.width
+			self.infos["imageHeight"] 	= pixels.height
+			self.infos["bakedRotate"] 	= spec.get("bakedRotate", 0)
+			self.rotatePixels(self.infos["bakedRotate"])
+		
+		self.imagePos 	= tuple(spec.get("imagePos", (0,0)))
+		if spec.get("rotate") == "auto":
+			self.deskew()
+		self.zoom 		= spec.get("zoom", 1)
+		
+		if spec.get("crop"):
+			self.document.setCrop(spec["crop"])
+		
+		for ladder in spec.get("ladders", []):
+			if ladder["name"] not in self.ladders:
+				raise KeyError("unknown ladder: %s" % ladder["name"])
+			if ladder.get("bands") == "auto":
+				self.document.addLadder(Ladder(ladder["name"], ladder["start"], ladder["stop"]))
+				self.detectBands()
+			else:
+				self.document.addLadder(Ladder(ladder["name"], ladder["start"], ladder["stop"], ladder.get("bands", [])))
+		
+		if spec.get("laneMarkers") == "auto":
+			self.detectLanes()
+		else:
+			self.document.setLaneMarkers(spec.get("laneMarkers", []))
+		
+		self.extents = self.fitExtents(spec.get("margin", 20))
+		
+		self.sizeTablePath = False
+		if spec.get("sizeTable"):
+			self.sizeTablePath 	= os.path.join(basePath, spec["sizeTable"])
+			self.calibrationKind = spec.get("calibration", "piecewise")
+	
+	def canvasExtents(self):
+		return self.extents
+	
+	def canvasSize(self):
+		left, top, right, bottom = self.extents
+		return (int(math.ceil((right-left)*self.zoom)), int(math.ceil((bottom-top)*self.zoom)))
+	
+	def fitExtents(self, margin):
+		''' user space box around the (cropped) image and all annotations '''
+		self.extents 	= self.imageExtents()
+		left, top, right, bottom = self.extents
+		points 			= [(left, top), (right, bottom)]
+		
+		# measure the annotations at the output scale
+		self.cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+		self.cr.scale(self.zoom, self.zoom)
+		for key, box in self.measureOverlay().items():
+			if key == "crop":
+				continue
+			points.append((box[0]/self.zoom, box[1]/self.zoom))
+			points.append((box[2]/self.zoom, box[3]/self.zoom))
+		
+		return (min(p[0] for p in points) - margin, min(p[1] for p in points) - margin,
+				max(p[0] for p in points) + margin, max(p[1] for p in points) + margin)
+	
+	def render(self, filepath):
+		'''	writes the gel as svg, png or pdf, depending on the extension,
+			and the size table if the spec asks for one
+		'''
+		written = self.writeFile(filepath, self.extents, self.zoom)
+		if self.sizeTablePath != False:
+			# once, even with several outputs
+			self.writeSizeTable(self.sizeTablePath, 0, self.calibrationKind)
+			written.append(self.sizeTablePath)
+			self.sizeTablePath = False
+		return written
+
+
+
+def imageSize(path):
+	'''	(width, height) from the header of an image file, False if unknown.
+		PIL can refuse very large images, then png and jpeg headers are
+		read directly
+	'''
+	if Image is not None:
+		try:
+			return Image.open(path).size
+		except Exception:
+			pass
+	with open(path, "rb") as f:
+		header = f.read(24)
+		if header[:8] == "\x89PNG\r\n\x1a\n":
+			return struct.unpack(">II", header[16:24])
+		if header[:2] == "\xff\xd8":
+			return jpegSize(f)
+	return False
+
+def jpegSize(f):
+	''' size from the frame header of a jpeg file, False if there is none '''
+	f.seek(2)
+	while True:
+		marker = f.read(2)
+		if len(marker) < 2 or marker[0] != "\xff":
+			return False
+		while marker[1] == "\xff":
+			marker = marker[1] + f.read(1) 	# fill bytes
+		code = ord(marker[1])
+		if 0xd0 <= code <= 0xd9 or code == 0x01:
+			continue 	# markers without a segment
+		length = f.read(2)
+		if len(length) < 2:
+			return False
+		length = struct.unpack(">H", length)[0]
+		if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+			segment = f.read(5)
+			if len(segment) < 5:
+				return False
+			height, width = struct.unpack(">HH", segment[1:5])
+			return (width, height)
+		f.seek(length - 2, 1)
+
+def loadPixels(path):
+	'''	loads an image as PixelBuffer without wx. png is read by cairo,
+		uncompressed tiff files directly, other formats need PIL
+	'''
+	fileType = os.path.splitext(path)[1].lower()
+	if fileType == ".png":
+		return PixelBuffer.fromSurface(cairo.ImageSurface.create_from_png(path))
+	if fileType in (".tif", ".tiff"):
+		try:
+			return PixelBuffer.fromTiff(TiffFile(path))
+		except ValueError:
+			pass
+	
+	if Image is None:
+		raise ValueError("%s: only png images can be read without PIL" % path)
+	return PixelBuffer.fromArray(numpy.asarray(Image.open(path).convert("RGB")))
+
+def encodeJpeg(surface, quality):
+	''' jpeg data of a cairo image surface, with PIL or else with wx '''
+	width 	= surface.get_width()
+	height 	= surface.get_height()
+	if Image is not None:
+		image 	= Image.frombuffer("RGB", (width, height), str(surface.get_data()), "raw", "BGRX", surface.get_stride(), 1)
+		data 	= io.BytesIO()
+		image.save(data, "JPEG", quality=quality)
+		return data.getvalue()
+	if wx is None:
+		raise ValueError("jpeg images in svg files need PIL or wxPython")
+	
+	image = wx.lib.wxcairo.BitmapFromImageSurface(surface).ConvertToImage()
+	image.SetOptionInt(wx.IMAGE_OPTION_QUALITY, quality)
+	handle, path = tempfile.mkstemp(".jpg")
+	os.close(handle)
+	try:
+		image.SaveFile(path, wx.BITMAP_TYPE_JPEG)
+		return open(path, "rb").read()
+	finally:
+		os.remove(path)
+
+def fileSize(paths):
+	''' human readable size of the written files '''
+	size = sum(os.path.getsize(path) for path in paths)
+	if size > 1024*1024:
+		return "%.1f MB" % (size/1024.0/1024.0)
+	return "%.1f kB" % (size/1024.0)
+
+def renderSpecFile(specPath, output=False, fileType=".svg"):
+	'''	renders one json spec file, returns the written files.
+		Relative paths in the spec are relative to the spec file
+	'''
+	spec 		= loadProject(specPath)		# spec or project file
+	basePath 	= os.path.dirname(os.path.abspath(specPath))
+	
+	# the lut divides by the gamma
+	levels = spec.get("levels")
+	if levels and levels != "auto" and len(levels) > 2 and not levels[2] > 0:
+		raise ValueError("%s: the gamma of the levels has to be greater than 0, not %s" % (specPath, levels[2]))
+	
+	if output != False:
+		outputs = [output]
+	else:
+		outputs = spec.get("output", "%s%s" % (os.path.splitext(specPath)[0], fileType))
+		if isinstance(outputs, basestring):
+			outputs = [outputs]
+		outputs = [os.path.join(basePath, path) for path in outputs]
+	
+	gel 	= HeadlessGel(spec, basePath)
+	written = []
+	for path in outputs:
+		written.extend(gel.render(path))
+	return written
+
+def renderSpecWorker(job):
+	'''	renders one spec in a worker process.
+		Errors are returned as text, so one bad file does not stop the batch
+	'''
+	specPath, output, fileType = job
+	try:
+		return (specPath, renderSpecFile(specPath, output, fileType), False)
+	except Exception as e:
+		return (specPath, [], "%s: %s" % (e.__class__.__name__, e))
+
+def renderBatch(specPaths, processes=0, inFlight=0, fileType=".svg", timeout=RENDER_TIMEOUT):
+	'''	renders many spec files in a pool of worker processes and yields
+		(specPath, outputs, error) as soon as a file is done.
+		Only inFlight files are given to the pool at once, so no more than
+		that many scans are decoded at the same time. A file without a
+		result timeout seconds after it was given to the pool is reported
+		as failed
+	'''
+	if processes <= 0:
+		processes = multiprocessing.cpu_count()
+	if inFlight <= 0:
+		inFlight = processes
+	
+	# workers are replaced from time to time to give memory back
+	pool 		= multiprocessing.Pool(processes, maxtasksperchild=20)
+	done 		= Queue.Queue()
+	pending 	= []	# (specPath, time it was given to the pool)
+	specPaths 	= iter(specPaths)
+	try:
+		while True:
+			while len(pending) < inFlight:
+				specPath = next(specPaths, None)
+				if specPath is None:
+					break
+				pool.apply_async(renderSpecWorker, ((specPath, False, fileType),), callback=done.put)
+				pending.append((specPath, time.time()))
+			
+			if len(pending) == 0:
+				break
+			# a short timeout keeps ctrl+c working and lets us look for lost files
+			try:
+				result = done.get(True, 1)
+			except Queue.Empty:
+				now = time.time()
+				for job in [job for job in pending if now - job[1] > timeout]:
+					pending.remove(job)
+					yield (job[0], [], "no result after %d seconds, the worker may have died" % timeout)
+				continue
+			
+			# results of files that timed out are dropped
+			for job in pending:
+				if job[0] == result[0]:
+					pending.remove(job)
+					yield result
+					break
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+def cli(argv):
+	''' command line interface to render gels without opening a window '''
+	parser = argparse.ArgumentParser(prog="gelImage.py",
+				description="Render annotated gel images from json spec files, without opening a window.")
+	parser.add_argument("specs", nargs="+", help="json spec files, see HeadlessGel for the format")
+	parser.add_argument("-o", "--output", default=False, help="output file, only for a single spec")
+	parser.add_argument("-f", "--format", default="svg", choices=["svg", "png", "pdf"],
+				help="format if the spec has no output (default: svg)")
+	parser.add_argument("-j", "--jobs", type=int, default=0,
+				help="number of worker processes (default: one per cpu core)")
+	parser.add_argument("--in-flight", type=int, default=0,
+				help="max number of gels loaded at the same time (default: --jobs)")
+	parser.add_argument("--timeout", type=int, default=RENDER_TIMEOUT,
+				help="seconds after which a gel counts as failed (default: %d)" % RENDER_TIMEOUT)
+	args = parser.parse_args(argv)
+	if args.output != False and len(args.specs) > 1:
+		parser.error("--output can only be used with a single spec file")
+	
+	fileType = ".%s" % args.format
+	if len(args.specs) == 1 or args.jobs == 1:
+		results = (renderSpecWorker((specPath, args.output, fileType)) for specPath in args.specs)
+	else:
+		results = renderBatch(args.specs, args.jobs, args.in_flight, fileType, args.timeout)
+	
+	failed = []
+	for specPath, outputs, error in results:
+		if error != False:
+			failed.append((specPath, error))
+			print >> sys.stderr, "%s: %s" % (specPath, error)
+		for path in outputs:
+			print "%s -> %s (%s)" % (specPath, path, fileSize([path]))
+	
+	if len(failed) > 0:
+		print >> sys.stderr, "\n%d of %d spec files failed:" % (len(failed), len(args.specs))
+		for specPath, error in failed:
+			print >> sys.stderr, "  %s: %s" % (specPath, error)
+		return 1
+	return 0
+
+
+
 # start the main loop here
 def main():
+    # with arguments we render spec files, no window needed
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
+    if wx is None:
+        sys.exit("the window needs wxPython, without it only spec files can be rendered (see --help)")
+
     ex = wx.App()
     f = gelImage(None)
     f.Show(True)  
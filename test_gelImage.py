@@ -0,0 +1,279 @@
+'''
+	Tests of the parts of gelImage that need no window:
+	python -m unittest test_gelImage
+'''
+import os
+import json
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+import gelImage
+
+
+
+def writeTiff(path, image, strip=7, tile=False, reverse=False):
+	'''	writes a little endian, uncompressed gray tiff. The strips (or
+		tiles) are stored in reverse order if asked, so they are not
+		one view on the memory map
+	'''
+	height, width = image.shape
+	chunks = []
+	if tile:
+		for top in range(0, height, tile):
+			for left in range(0, width, tile):
+				chunk = numpy.zeros((tile, tile), image.dtype)
+				part = image[top:top+tile, left:left+tile]
+				chunk[:part.shape[0], :part.shape[1]] = part
+				chunks.append(chunk.astype(image.dtype.newbyteorder("<")).tostring())
+	else:
+		for top in range(0, height, strip):
+			chunks.append(image[top:top+strip].astype(image.dtype.newbyteorder("<")).tostring())
+
+	order = range(len(chunks))
+	if reverse:
+		order = order[::-1]
+	data 		= ""
+	offsets 	= [0] * len(chunks)
+	for index in order:
+		offsets[index] = 8 + len(data)
+		data = data + chunks[index]
+
+	tags = [(256, 4, [width]), (257, 4, [height]), (258, 3, [8 * image.dtype.itemsize]),
+			(259, 3, [1]), (262, 3, [1]), (277, 3, [1])]
+	if tile:
+		tags += [(322, 4, [tile]), (323, 4, [tile]), (324, 4, offsets), (325, 4, [len(c) for c in chunks])]
+	else:
+		tags += [(273, 4, offsets), (278, 4, [strip]), (279, 4, [len(c) for c in chunks])]
+
+	ifd 	= 8 + len(data)
+	extra 	= ifd + 2 + 12*len(tags) + 4
+	entries = ""
+	values 	= ""
+	for tag, fieldType, items in tags:
+		packed = struct.pack("<%d%s" % (len(items), {3: "H", 4: "I"}[fieldType]), *items)
+		if len(packed) <= 4:
+			entries += struct.pack("<HHI", tag, fieldType, len(items)) + packed.ljust(4, "\0")
+		else:
+			entries += struct.pack("<HHII", tag, fieldType, len(items), extra + len(values))
+			values += packed
+	with open(path, "wb") as f:
+		f.write("II" + struct.pack("<HI", 42, ifd) + data)
+		f.write(struct.pack("<H", len(tags)) + entries + struct.pack("<I", 0) + values)
+
+
+
+class TempDirTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def path(self, name):
+		return os.path.join(self.folder, name)
+
+
+
+class TiffFileTest(TempDirTest):
+	def setUp(self):
+		TempDirTest.setUp(self)
+		self.image = numpy.random.RandomState(0).randint(0, 60000, (101, 130)).astype(numpy.uint16)
+
+	def checkRegions(self, tiff):
+		full = self.image[..., numpy.newaxis]
+		for step in (1, 2, 5):
+			for x, y, width, height in ((0, 0, 130, 101), (13, 29, 70, 50), (120, 95, 10, 6)):
+				region = tiff.read(x, y, width, height, step)
+				expected = full[y:y+height:step, x:x+width:step]
+				self.assertEqual(region.shape, expected.shape)
+				self.assertTrue((region == expected).all())
+		self.assertTrue((tiff.sample(4) == full[::4, ::4]).all())
+		self.assertTrue((tiff.view()[10:40:3, 5:100:3, 0] == self.image[10:40:3, 5:100:3]).all())
+		self.assertTrue((tiff.view()[10:40, 5:100:2] == full[10:40, 5:100:2]).all())
+
+	def testContiguous(self):
+		writeTiff(self.path("a.tif"), self.image)
+		tiff = gelImage.TiffFile(self.path("a.tif"))
+		self.assertTrue(isinstance(tiff.view(), numpy.ndarray))
+		self.checkRegions(tiff)
+
+	def testScatteredStrips(self):
+		writeTiff(self.path("a.tif"), self.image, reverse=True)
+		tiff = gelImage.TiffFile(self.path("a.tif"))
+		self.assertTrue(tiff.view() is tiff)
+		self.checkRegions(tiff)
+
+	def testTiles(self):
+		writeTiff(self.path("a.tif"), self.image, tile=32)
+		self.checkRegions(gelImage.TiffFile(self.path("a.tif")))
+
+	def testDisplayOnDemand(self):
+		writeTiff(self.path("a.tif"), self.image, reverse=True)
+		pixels = gelImage.PixelBuffer.fromTiff(gelImage.TiffFile(self.path("a.tif")))
+		self.assertFalse(pixels.shownRows.any())
+		lut = pixels.pending[0]
+		pixels.showRows(10, 20)
+		self.assertTrue((pixels.rgb[10:20, :, 1] == lut[self.image[10:20]]).all())
+		pixels.showAll()
+		self.assertTrue(pixels.pending is False)
+		self.assertTrue((pixels.rgb[..., 0] == lut[self.image]).all())
+
+
+
+class ProfileTest(unittest.TestCase):
+	def testSingleLane(self):
+		profile = numpy.full(400, 200.0)
+		profile[100:141] = 50
+		lanes = gelImage.findLanes(profile, dark=True)
+		self.assertEqual(len(lanes), 1)
+		self.assertAlmostEqual(lanes[0], 120, delta=1)
+
+	def testWideLanes(self):
+		profile = numpy.full(38*12 + 40, 200.0)
+		centres = []
+		for i in range(12):
+			left = 30 + 38*i
+			profile[left:left+32] = 60
+			centres.append(left + 15.5)
+		lanes = gelImage.findLanes(profile, dark=True)
+		self.assertEqual(len(lanes), 12)
+		self.assertTrue(numpy.abs(lanes - centres).max() < 1)
+
+	def testPolarity(self):
+		profile = numpy.full(400, 200.0)
+		for left in range(20, 380, 60):
+			profile[left:left+40] = 50
+		self.assertTrue(gelImage.darkBands(profile))
+		self.assertFalse(gelImage.darkBands(255 - profile))
+
+	def testSaturatedBands(self):
+		x 		= numpy.arange(1000.0)
+		true 	= numpy.array([200.3, 500.0, 800.7])
+		profile = numpy.minimum(sum(numpy.exp(-(x - c)**2 / 32.0) for c in true) * 1000, 300)
+		bands 	= gelImage.findBands(profile, 3, dark=False)
+		self.assertTrue(numpy.abs(bands - true).max() < 0.1)
+		bands 	= gelImage.findBands(profile.max() - profile, 3, dark=True)
+		self.assertTrue(numpy.abs(bands - true).max() < 0.1)
+
+
+
+class LadderCalibrationTest(unittest.TestCase):
+	def testBandsAtTheSamePosition(self):
+		for kind in ("loglinear", "piecewise", "spline"):
+			self.assertRaises(ValueError, gelImage.LadderCalibration, [1000, 500, 400, 200], [10, 20, 20, 40], kind)
+		self.assertRaises(ValueError, gelImage.LadderCalibration, [1000, 500], [10, 10])
+
+	def testThroughTheBands(self):
+		sizes 		= [1000, 500, 200, 100]
+		positions 	= [10, 20, 40, 45]
+		for kind in ("piecewise", "spline"):
+			calibration = gelImage.LadderCalibration(sizes, positions, kind)
+			self.assertTrue(numpy.allclose(calibration.sizes(positions), sizes))
+			self.assertAlmostEqual(calibration.position(500), 20, places=6)
+
+	def testLoglinear(self):
+		calibration = gelImage.LadderCalibration([1000, 100], [0, 10])
+		self.assertAlmostEqual(calibration.sizes([5])[0], 10 ** 2.5)
+		self.assertAlmostEqual(calibration.position(10 ** 2.5), 5)
+
+
+
+class ProjectRecordTest(unittest.TestCase):
+	def testRoundTrip(self):
+		old = {"unit": "bp", "ladders": [1, 2, 3, 4], "markers": [[0, 0]], "gone": 1}
+		new = {"unit": "kbp", "ladders": [1, 9, 3, 4, 5], "markers": [[0, 0], [1, 1]]}
+		record = gelImage.diffState(old, new)
+		self.assertEqual(record["items"], {"ladders": {"1": 9}})
+		state = json.loads(json.dumps(old))
+		self.assertEqual(gelImage.applyRecord(state, json.loads(json.dumps(record))), new)
+
+	def testTornTail(self):
+		records, complete = gelImage.readRecords('{"a": 1}\n{"set": {"a": 2}}\n{"set": {"a"')
+		self.assertEqual(records, [{"a": 1}, {"set": {"a": 2}}])
+		self.assertFalse(complete)
+
+
+
+class DocumentHistoryTest(unittest.TestCase):
+	def testUndoRedo(self):
+		document 	= gelImage.GelDocument()
+		history 	= gelImage.DocumentHistory(document)
+		self.assertFalse(history.commit(document))
+
+		document.addLaneMarker((1, 2))
+		self.assertTrue(history.commit(document))
+		document.addLaneMarker((3, 4))
+
+		document = history.undo(document)
+		self.assertEqual(document.laneMarkers, ((1.0, 2.0),))
+		document = history.undo(document)
+		self.assertEqual(document.laneMarkers, ())
+		self.assertFalse(history.undo(document))
+
+		document = history.redo(document)
+		self.assertEqual(document.laneMarkers, ((1.0, 2.0),))
+
+		# a new change drops the steps that were undone
+		document.setCrop(((0, 0), (5, 5)))
+		history.commit(document)
+		self.assertFalse(history.canRedo())
+		steps, present = history.steps()
+		self.assertEqual(len(steps), 3)
+		self.assertEqual(present, 2)
+
+
+
+class SpatialGridTest(unittest.TestCase):
+	def testQuery(self):
+		grid = gelImage.SpatialGrid(10, maxCells=16)
+		grid.insert("a", (0, 0, 5, 5))
+		grid.insert("b", (3, 3, 20, 20))
+		grid.insert("large", (-500, -500, 500, 500))
+		self.assertEqual(grid.query(4, 4), ["large", "b", "a"])
+		self.assertEqual(grid.query(15, 15), ["large", "b"])
+		self.assertEqual(grid.query(600, 0), [])
+
+
+
+class SizeTableTest(TempDirTest):
+	def testLaneOutsideOfTheCrop(self):
+		# dark lanes at 40, 100 and 160 with bands in rows 30, 60 and 90
+		image = numpy.full((120, 200), 60000, numpy.uint16)
+		for centre in (40, 100, 160):
+			image[:, centre-10:centre+10] = 20000
+			for row in (30, 60, 90):
+				image[row-1:row+2, centre-10:centre+10] = 2000
+		writeTiff(self.path("gel.tif"), image)
+
+		gel = gelImage.HeadlessGel({"image": "gel.tif"}, self.folder)
+		ladder = gelImage.Ladder("NEB 1 kb DNA Ladder", (-80, -60), (-80, 60), [(-60, -29.5), (-60, 0.5)])
+		gel.document.addLadder(ladder)
+		# the first lane is left of the crop
+		gel.document.setCrop(((-30, -60), (100, 60)))
+		gel.document.setLaneMarkers([(-60, 0), (0, 0), (60, 0)])
+
+		rows = gel.sizeTable(0, "loglinear", True)
+		self.assertEqual(sorted(set(row[0] for row in rows)), [2, 3])
+		self.assertEqual(len(rows), 6)
+		first = [row for row in rows if row[0] == 2 and row[1] == 1][0]
+		self.assertAlmostEqual(first[3], 10000, delta=200)
+
+
+
+class SpecTest(TempDirTest):
+	def testGammaZero(self):
+		path = self.path("gel.json")
+		with open(path, "wb") as f:
+			json.dump({"image": "gel.png", "levels": [0, 255, 0]}, f)
+		with self.assertRaises(ValueError) as context:
+			gelImage.renderSpecFile(path)
+		self.assertTrue(path in str(context.exception))
+
+
+
+if __name__ == '__main__':
+	unittest.main()